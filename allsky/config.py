@@ -8,10 +8,31 @@ DATABASEPATH = BASEPATH+'data/allsky_data.csv'
 LOG_INTERVAL = 30 # seconds
 
 # ZWO
+ZWO_BACKEND = 'asi' # 'asi' for the camera, 'sim' for the simulated camera (allsky.zwosim)
 SDK_LIB_PATH = BASEPATH + 'data/libASICamera2.so'
 ZWO_LOG = BASEPATH + 'data/zwoStatus.log'
 ZWO_EXPMAX = 10 # seconds
+ZWO_EXPMIN = 32e-6 # seconds
 ZWO_GAINMAX = 50 
+ZWO_METER_STEP = 4 # decimation of the frames used for metering
+ZWO_METER_RADIUS = 0.9 # fraction of the sky circle used for metering
+ZWO_METER_BINS = 2 # binning of the metering frames (1 to meter at full resolution)
+ZWO_METER_ROI = True # crop the metering frames to the square around the sky circle
+ZWO_AUTOEXP_SOLVER = 'histogram' # 'histogram' (predictive) or 'ratio'
+ZWO_TEMP_REFRESH = 60 # seconds between sensor temperature reads
+ZWO_VIDEO_BUFFERS = 4 # frames in the video ring buffer
+ZWO_SIM_USB_BANDWIDTH = 40e6 # bytes/s, for the simulated camera
+ZWO_SIM_READOUT_OVERHEAD = 0.05 # seconds, for the simulated camera
+
+# Background writer
+WRITER_WORKERS = 2
+WRITER_QUEUE_SIZE = 4 # frames waiting to be written, before the capture blocks
+
+# Timing (per-stage latencies, see allsky.timing)
+TIMING_WINDOW = 500 # spans per stage kept for the percentiles and histograms
+TIMING_FILE = BASEPATH + 'data/timing.json'
+TIMING_TRACE_FILE = None # e.g. BASEPATH + 'data/timing_trace.json' to write a chrome trace
+TIMING_TRACE_EVENTS = 20000 # spans kept for the chrome trace
 
 # DHT Sensor
 DHT_SENSOR_TYPE = 11
@@ -29,9 +50,61 @@ SHELL_LOG = BASEPATH + 'data/shellPos.log'
 CERECEDA_ALLSKY_LAT =  43.25916375853605 
 CERECEDA_ALLSKY_LON = -6.603491884147439
 
+# Sky phases: sun altitude on a grid around the current time, to find the sunset, sunrise and twilight times
+OBS_TIMELINE_STEP = 300 # seconds between grid points
+OBS_TIMELINE_BEFORE = 6*3600 # seconds before the current time
+OBS_TIMELINE_AFTER = 30*3600 # seconds after the current time
+# IERS tables (earth orientation) for astropy. Offline: never try to download them (astropy may block for a while
+# when the network is flaky); use IERS_A_FILE if it exists (e.g. finals2000A.all from https://datacenter.iers.org,
+# updated by hand) or the table bundled with astropy
+IERS_OFFLINE = True
+IERS_A_FILE = BASEPATH + 'data/finals2000A.all'
+IERS_MAX_AGE = 180 # days: warn when the table is older than this
+IERS_DEGRADED = 'warn' # 'warn', 'ignore' or 'error' for times out of the table (sun and moon positions only need ~1 s)
+OBS_EPHEM_STEP = 600 # seconds between the computed moon and planet positions (interpolated in between)
+OBS_EPHEM_SPAN = 24*3600 # seconds covered by each ephemeris grid
+OBS_BATCH_STEP = 6*3600 # seconds between the exact sun positions for the batch classification (interpolated in between)
+
 OUTPUT_IMAGES_DIR = '/media/astroberry/E8C6-3E053/pics/'
 OUTPUT_TIMELAPSE_DIR = '/media/astroberry/E8C6-3E053/timelapses/'
 OUTPUT_DARKS_DIR = '/media/astroberry/E8C6-3E053/darks/'
+OUTPUT_PRODUCTS_DIR = '/media/astroberry/E8C6-3E053/products/'
+
+# Night batch processing (allsky/scripts/ProcessNight.py)
+IMGPROC_TILED = False # calibrate and debayer in bands of rows (bounded memory, identical output)
+IMGPROC_MEMORY_BUDGET = 16*1024**2 # bytes of working memory of the tiled mode
+NIGHT_WORKERS = 2 # processes calibrating and debayering the frames
+NIGHT_MANIFEST = 'processed.json' # checkpoint of the processed frames, in the night folder
+NIGHT_DELETE_FITS = False # delete the FITs once their jpeg is written...
+NIGHT_KEEP_PREFIX = 'gain0' # ...except these
+NIGHT_USE_CACHE = False # keep the products of each stage in the product cache (allsky.products), so re-runs only redo what changed
+NIGHT_CACHE_STAGES = ['calibrated', 'debayered', 'jpeg', 'thumbnail'] # stages kept in the cache
+NIGHT_THUMBNAIL_WIDTH = 320 # pixels, thumbnails in the thumbs folder of the night (None: no thumbnails)
+PRODUCTS_BUDGET = 4*1024**3 # bytes of the product cache
+
+# Dark library (see allsky.darklib)
+DARKS_INDEX = OUTPUT_DARKS_DIR + 'index.json'
+DARKS_DISTANCE_SCALES = (50, 2, 20) # differences in temperature (0.1 C), exposure (s) and gain that count as one unit of distance
+DARKS_MEMORY_BUDGET = 64*1024**2 # bytes of working memory to combine darks into a master
+DARKS_SIGMA = 3. # clipping for the sigma-clipped mean
+DARKS_FRAMES = 10 # darks per point of the library
+DARKS_MERGE_WORKERS = 2 # processes combining masters in parallel (each one uses up to DARKS_MEMORY_BUDGET)
+# Per-pixel dark model fitted from the masters: bias + offset*G + current*G*exp*2**((temp - T0)/TDOUBLE), G = gain factor
+DARKS_MODEL_FILE = OUTPUT_DARKS_DIR + 'model.npz'
+DARKS_MODEL_T0 = 20. # C
+DARKS_MODEL_TDOUBLE = 6.3 # C to double the dark current
+DARKS_MODEL_CACHE = 8 # synthesized darks kept in memory
+DARKS_USE_MODEL = False # calibrate with synthesized darks instead of the nearest master
+DARKS_CACHE_BUDGET = 128*1024**2 # bytes of master darks kept in memory to calibrate the frames
+DARKS_HOTPIXELS_FILE = OUTPUT_DARKS_DIR + 'hotpixels.npz' # hot/dead pixel coordinates per (temp, gain) bucket
+DARKS_HOT_SIGMA = 8. # robust sigmas from the median of a master to flag a pixel as hot (or dead)
+# Dark acquisition (TakeDarks.take_darks): grid of the library and priorities of the missing points
+DARKS_EXPOSURES = list(range(1, 21)) # s
+DARKS_GAINS = list(range(0, 101, 10))
+DARKS_TEMP_STEP = 5 # 0.1 C
+DARKS_MAX_DISTANCE = 3. # distance to the nearest master (see DARKS_DISTANCE_SCALES) above which a point is fully missing
+DARKS_REST = 1. # seconds between darks
+DARKS_REPORT_EVERY = 50 # frames between throughput reports
 
 TIME_INTERVAL_DAY = 30
 TIME_INTERVAL_NIGHT = 30
@@ -0,0 +1,387 @@
+'''
+ Index of the master darks in OUTPUT_DARKS_DIR (temp(0.1C)/exp(s)/gain/temp_gain_exp_master.fit), kept in a json
+ file next to them. It is built with a single walk of the tree and updated when a master is written, so the
+ lookups never list the directories on the USB stick:
+
+   lib = GetDarkLibrary()
+   path = lib.Find(temp, exp, gain)          # nearest master, temp in 0.1 C
+   lib.Add(temp, exp, gain, path, ncombine)  # after writing a new master
+
+   >> python -m allsky.darklib --scan        # rebuild the index
+
+ Masters are combined with CombineDarks, in row tiles read from memory-mapped FITs so the memory is bounded.
+
+ DarkModel fits a per-pixel model (bias, gain-dependent offset and thermal current) to all the masters, and
+ synthesizes a dark for any temperature, exposure and gain:
+
+   model = DarkModel().Fit(GetDarkLibrary())   # or: python -m allsky.darklib --fit-model
+   dark = model.Synthesize(temp, exp, gain)    # temp in C, exp in s
+
+ The masters used to calibrate the frames are kept in memory by DarkCache (LRU bounded in bytes), so a night of
+ frames reads each master only once:
+
+   data = GetDarkCache().Subtract(data, path)  # in place when data is float32
+
+ HotPixelMaps keeps the coordinates of the hot and dead pixels of the masters, one map per (temp, gain) bucket,
+ so the frames only fix those pixels (see allsky.imgproc.correct_hot_pixels):
+
+   >> python -m allsky.darklib --hot-pixels    # extract the maps from the masters
+'''
+
+import os, json, time, argparse
+from collections import OrderedDict
+import numpy as np
+
+from allsky.config import OUTPUT_DARKS_DIR, DARKS_INDEX, DARKS_DISTANCE_SCALES, DARKS_MEMORY_BUDGET, DARKS_SIGMA
+from allsky.config import DARKS_MODEL_FILE, DARKS_MODEL_T0, DARKS_MODEL_TDOUBLE, DARKS_MODEL_CACHE
+from allsky.config import DARKS_CACHE_BUDGET, DARKS_HOTPIXELS_FILE, DARKS_HOT_SIGMA
+from allsky.exposure import GainFactor
+
+# Working arrays per stacked value for each method: the float32 stack plus the temporaries of the median/clipping
+COMBINE_COPIES = {'median': 3, 'mean': 2, 'sigma': 8}
+
+def SigmaClippedMean(stack, sigma=DARKS_SIGMA, iterations=3):
+  ''' Mean along the first axis, rejecting the values further than sigma std from the median (first iteration)
+      or from the clipped mean (next ones) '''
+  center = np.median(stack, axis=0)
+  std = np.std(stack, axis=0)
+  keep = np.ones(stack.shape, dtype=bool)
+  for i in range(iterations):
+    clipped = np.abs(stack - center) <= sigma*std
+    if np.array_equal(clipped, keep) and i > 0: break
+    keep = clipped
+    n = np.maximum(keep.sum(axis=0, dtype=np.float32), 1)
+    center = np.where(keep, stack, 0).sum(axis=0) / n
+    std = np.sqrt(np.where(keep, (stack - center)**2, 0).sum(axis=0) / n)
+  return center
+
+def CombineDarks(dark_files, method='median', sigma=DARKS_SIGMA, memory=DARKS_MEMORY_BUDGET):
+  ''' Combine dark frames into a float32 master: median, mean or sigma (sigma-clipped mean).
+      The frames are read in row tiles from memory-mapped FITs, so the working memory is about memory bytes '''
+  from astropy.io import fits
+  hduls = [fits.open(f, memmap=True, do_not_scale_image_data=True) for f in dark_files]
+  try:
+    hdus = [h[0] for h in hduls]
+    height, width = hdus[0].data.shape
+    scales = [(h.header.get('BSCALE', 1.), h.header.get('BZERO', 0.)) for h in hdus]
+    if method not in COMBINE_COPIES: raise ValueError('Unknown method to combine darks: %s'%method)
+    rows = max(1, min(height, int(memory // (len(hdus) * width * 4 * COMBINE_COPIES[method]))))
+    master = np.empty((height, width), dtype=np.float32)
+    stack = np.empty((len(hdus), rows, width), dtype=np.float32)
+    for r0 in range(0, height, rows):
+      r1 = min(height, r0 + rows)
+      tile = stack[:, :r1-r0]
+      for i, (hdu, (bscale, bzero)) in enumerate(zip(hdus, scales)):
+        tile[i] = hdu.data[r0:r1]
+        if bscale != 1: tile[i] *= bscale
+        if bzero: tile[i] += bzero
+      if method == 'median':
+        master[r0:r1] = np.median(tile, axis=0)
+      elif method == 'mean':
+        master[r0:r1] = np.mean(tile, axis=0)
+      else:
+        master[r0:r1] = SigmaClippedMean(tile, sigma)
+  finally:
+    for h in hduls: h.close()
+  return master
+
+class DarkLibrary:
+  def __init__(self, path=OUTPUT_DARKS_DIR, index=DARKS_INDEX, scales=DARKS_DISTANCE_SCALES, rescan=False):
+    self.path = path
+    self.index = index
+    self.scales = np.array(scales, dtype=float)
+    self.masters = {} # (temp, exp, gain) --> {'temp', 'exp', 'gain', 'path' (relative), 'ncombine', 'date'}
+    self.memo = {}
+    self.keys = None
+    if not rescan and self.index is not None and os.path.isfile(self.index):
+      self.Load()
+    else:
+      self.Scan()
+
+  def Load(self):
+    with open(self.index) as f:
+      for m in json.load(f)['masters']:
+        self.masters[(m['temp'], m['exp'], m['gain'])] = m
+    self.Changed()
+
+  def Save(self):
+    ''' Write the index (atomic) '''
+    if self.index is None: return
+    temp = self.index + '.tmp'
+    with open(temp, 'w') as f:
+      json.dump({'updated': time.strftime('%Y-%m-%dT%H:%M:%S'), 'masters': [self.masters[k] for k in sorted(self.masters)]}, f, indent=1)
+    os.replace(temp, self.index)
+
+  def Changed(self):
+    self.keys = np.array(sorted(self.masters), dtype=float).reshape(-1, 3)
+    self.memo = {}
+
+  def Scan(self):
+    ''' Rebuild the index with a single walk of the darks tree '''
+    from astropy.io import fits
+    self.masters = {}
+    for root, dirs, files in os.walk(self.path):
+      for f in files:
+        if not f.endswith('_master.fit'): continue
+        try:
+          temp, gain, exp = [int(x) for x in f.split('_')[:3]]
+        except ValueError:
+          continue
+        filename = os.path.join(root, f)
+        ncombine = fits.getheader(filename).get('NCOMBINE')
+        self.Add(temp, exp, gain, filename, ncombine, date=os.path.getmtime(filename), save=False)
+    self.Changed()
+    self.Save()
+
+  def Add(self, temp, exp, gain, path, ncombine=None, date=None, save=True):
+    ''' Add (or replace) a master: temp in 0.1 C, exp in s '''
+    key = (int(temp), int(exp), int(gain))
+    self.masters[key] = {'temp': key[0], 'exp': key[1], 'gain': key[2], 'path': os.path.relpath(path, self.path),
+                         'ncombine': ncombine, 'date': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(date))}
+    if save:
+      self.Changed()
+      self.Save()
+
+  def Remove(self, temp, exp, gain):
+    self.masters.pop((int(temp), int(exp), int(gain)), None)
+    self.Changed()
+    self.Save()
+
+  def FindEntry(self, temp, exp, gain):
+    ''' Entry of the nearest master (weighted distance in temperature, exposure and gain), or None if the library is empty '''
+    query = (float(temp), float(exp), float(gain))
+    if query not in self.memo:
+      if len(self.keys) == 0: return None
+      distance = (np.abs(self.keys - query) / self.scales).sum(axis=1)
+      self.memo[query] = self.masters[tuple(int(x) for x in self.keys[np.argmin(distance)])]
+    return self.memo[query]
+
+  def Find(self, temp, exp, gain):
+    ''' Path of the nearest master, or None if the library is empty '''
+    entry = self.FindEntry(temp, exp, gain)
+    return None if entry is None else os.path.join(self.path, entry['path'])
+
+  def __len__(self):
+    return len(self.masters)
+
+
+def DarkFeatures(temp, exp, gain, t0=DARKS_MODEL_T0, tdouble=DARKS_MODEL_TDOUBLE):
+  ''' Features of the dark model for temp (C), exp (s) and gain: bias, gain-dependent offset and thermal signal '''
+  g = GainFactor(gain)
+  return np.array([1., g, g*exp*2**((temp - t0)/tdouble)])
+
+def ReadMaster(filename):
+  ''' Master as a native-endian float32 array (the FITs are big-endian: converted once here, not at every use) '''
+  from astropy.io import fits
+  with fits.open(filename, memmap=True) as hdul:
+    return np.array(hdul[0].data, dtype=np.float32)
+
+class DarkModel:
+  def __init__(self, filename=DARKS_MODEL_FILE, cachesize=DARKS_MODEL_CACHE):
+    self.filename = filename
+    self.cachesize = cachesize
+    self.cache = OrderedDict() # (temp, exp, gain) --> synthesized dark, least recently used first
+    self.coef = None
+    self.t0, self.tdouble = DARKS_MODEL_T0, DARKS_MODEL_TDOUBLE
+    self.rms = None
+    if filename is not None and os.path.isfile(filename): self.Load()
+
+  def Load(self):
+    with np.load(self.filename) as f:
+      self.coef = f['coef']
+      self.t0, self.tdouble, self.rms = float(f['t0']), float(f['tdouble']), f['rms'].tolist()
+    self.cache.clear()
+
+  def Save(self):
+    temp = self.filename + '.tmp.npz'
+    np.savez(temp, coef=self.coef, t0=self.t0, tdouble=self.tdouble, rms=np.array(self.rms))
+    os.replace(temp, self.filename)
+
+  def Fit(self, library, save=True):
+    ''' Least-squares fit per pixel to all the masters of the library; the normal equations are accumulated one
+        master at a time (the 3x3 matrix is the same for all the pixels) '''
+    entries = list(library.masters.values())
+    if len(entries) < 3: raise ValueError('At least 3 masters are needed to fit the dark model')
+    ata = np.zeros((3, 3))
+    aty = None
+    for m in entries:
+      f = DarkFeatures(m['temp']/10., m['exp'], m['gain'], self.t0, self.tdouble)
+      data = ReadMaster(os.path.join(library.path, m['path']))
+      if aty is None: aty = np.zeros((3,) + data.shape)
+      ata += np.outer(f, f)
+      for i in range(3): aty[i] += f[i] * data
+    self.coef = np.tensordot(np.linalg.pinv(ata), aty, axes=1).astype(np.float32)
+    # Residuals (rms per master, in ADU)
+    self.rms = []
+    self.cache.clear()
+    for m in entries:
+      data = ReadMaster(os.path.join(library.path, m['path']))
+      self.rms.append(float(np.sqrt(np.mean((data - self.Synthesize(m['temp']/10., m['exp'], m['gain'], cache=False))**2))))
+    if save and self.filename is not None: self.Save()
+    return self
+
+  def Synthesize(self, temp, exp, gain, cache=True):
+    ''' Dark (float32) for temp (C), exp (s) and gain; the last ones are kept in a LRU cache '''
+    if self.coef is None: raise ValueError('The dark model has not been fitted')
+    key = (round(float(temp), 1), round(float(exp), 6), int(gain))
+    if key in self.cache:
+      self.cache.move_to_end(key)
+      return self.cache[key]
+    f = DarkFeatures(*key, self.t0, self.tdouble).astype(np.float32)
+    dark = self.coef[0] * f[0]
+    dark += self.coef[1] * f[1]
+    dark += self.coef[2] * f[2]
+    if cache:
+      self.cache[key] = dark
+      if len(self.cache) > self.cachesize: self.cache.popitem(last=False)
+    return dark
+
+class DarkCache:
+  def __init__(self, budget=DARKS_CACHE_BUDGET):
+    self.budget = budget
+    self.darks = OrderedDict() # path --> (mtime, float32 array), least recently used first
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  def Get(self, filename):
+    ''' Master dark (float32), read from disk only if it is not in the cache or the file has been rewritten '''
+    mtime = os.path.getmtime(filename)
+    entry = self.darks.get(filename)
+    if entry is not None and entry[0] == mtime:
+      self.hits += 1
+      self.darks.move_to_end(filename)
+      return entry[1]
+    self.misses += 1
+    if entry is not None: self.Evict(filename)
+    dark = ReadMaster(filename)
+    self.darks[filename] = (mtime, dark)
+    self.nbytes += dark.nbytes
+    while self.nbytes > self.budget and len(self.darks) > 1:
+      self.Evict(next(iter(self.darks)))
+    return dark
+
+  def Evict(self, filename):
+    self.nbytes -= self.darks.pop(filename)[1].nbytes
+
+  def Subtract(self, data, filename):
+    ''' Subtract a master dark from data: in place if data is float32, else into a new float32 array '''
+    dark = self.Get(filename)
+    if data.dtype != np.float32: data = data.astype(np.float32)
+    np.subtract(data, dark, out=data)
+    return data
+
+  def Stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'darks': len(self.darks), 'bytes': self.nbytes}
+
+  def Clear(self):
+    self.darks.clear()
+    self.nbytes = 0
+
+def FindHotPixels(master, sigma=DARKS_HOT_SIGMA):
+  ''' Flat indices (uint32) of the pixels of a master further than sigma robust std (MAD) from its median '''
+  median = np.median(master)
+  std = 1.4826 * np.median(np.abs(master - median))
+  return np.flatnonzero(np.abs(master - median) > sigma * max(std, 1e-6)).astype(np.uint32)
+
+class HotPixelMaps:
+  def __init__(self, filename=DARKS_HOTPIXELS_FILE, scales=DARKS_DISTANCE_SCALES):
+    self.filename = filename
+    self.scales = np.array(scales, dtype=float)[[0, 2]]
+    self.maps = {} # (temp, gain) --> flat indices
+    self.shape = None
+    self.Changed()
+    if filename is not None and os.path.isfile(filename): self.Load()
+
+  def Load(self):
+    with np.load(self.filename) as f:
+      self.shape = tuple(int(x) for x in f['shape'])
+      self.maps = {tuple(int(x) for x in k.split('_')): f[k] for k in f.files if k != 'shape'}
+    self.Changed()
+
+  def Save(self):
+    temp = self.filename + '.tmp.npz'
+    np.savez_compressed(temp, shape=np.array(self.shape), **{'%i_%i'%k: v for k, v in self.maps.items()})
+    os.replace(temp, self.filename)
+
+  def Changed(self):
+    self.keys = np.array(sorted(self.maps), dtype=float).reshape(-1, 2)
+    self.memo = {}
+
+  def Build(self, library, sigma=DARKS_HOT_SIGMA, save=True):
+    ''' One map per (temp, gain) bucket, from its longest exposure master (where the hot pixels stand out most) '''
+    longest = {}
+    for m in library.masters.values():
+      key = (m['temp'], m['gain'])
+      if key not in longest or m['exp'] > longest[key]['exp']: longest[key] = m
+    self.maps = {}
+    for key, m in longest.items():
+      master = ReadMaster(os.path.join(library.path, m['path']))
+      self.shape = master.shape
+      self.maps[key] = FindHotPixels(master, sigma)
+    self.Changed()
+    if save and self.filename is not None: self.Save()
+    return self
+
+  def Get(self, temp, gain):
+    ''' Flat indices of the hot pixels of the nearest bucket (temp in 0.1 C), or None if there are no maps '''
+    query = (float(temp), float(gain))
+    if query not in self.memo:
+      if len(self.keys) == 0: return None
+      distance = (np.abs(self.keys - query) / self.scales).sum(axis=1)
+      self.memo[query] = self.maps[tuple(int(x) for x in self.keys[np.argmin(distance)])]
+    return self.memo[query]
+
+  def __len__(self):
+    return len(self.maps)
+
+
+# Library shared by the calibration functions
+library = None
+model = None
+cache = None
+hotpixels = None
+
+def GetDarkLibrary():
+  global library
+  if library is None: library = DarkLibrary()
+  return library
+
+def GetDarkModel():
+  global model
+  if model is None: model = DarkModel()
+  return model
+
+def GetDarkCache():
+  global cache
+  if cache is None: cache = DarkCache()
+  return cache
+
+def GetHotPixelMaps():
+  global hotpixels
+  if hotpixels is None: hotpixels = HotPixelMaps()
+  return hotpixels
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Index of the master darks')
+  parser.add_argument('--scan', action='store_true', help='Rebuild the index walking the darks folder')
+  parser.add_argument('--path', default=OUTPUT_DARKS_DIR, help='Darks folder')
+  parser.add_argument('--fit-model', action='store_true', help='Fit the dark model to the masters')
+  parser.add_argument('--hot-pixels', action='store_true', help='Extract the hot pixel maps from the masters')
+  parser.add_argument('--find', nargs=3, type=float, default=None, metavar=('TEMP', 'EXP', 'GAIN'), help='Find the nearest master (temp in 0.1 C, exp in s)')
+  args = parser.parse_args()
+
+  t0 = time.time()
+  lib = DarkLibrary(args.path, index=os.path.join(args.path, os.path.basename(DARKS_INDEX)), rescan=args.scan)
+  print('%i masters (%1.2f s)'%(len(lib), time.time() - t0))
+  if args.find is not None:
+    print(lib.FindEntry(*args.find))
+  if args.fit_model:
+    t0 = time.time()
+    dm = DarkModel(os.path.join(args.path, os.path.basename(DARKS_MODEL_FILE))).Fit(lib)
+    print('Dark model fitted to %i masters in %1.1f s: rms residual = %1.2f ADU (max %1.2f)'%(len(dm.rms), time.time() - t0, np.mean(dm.rms), np.max(dm.rms)))
+  if args.hot_pixels:
+    t0 = time.time()
+    hp = HotPixelMaps(os.path.join(args.path, os.path.basename(DARKS_HOTPIXELS_FILE))).Build(lib)
+    counts = [len(v) for v in hp.maps.values()]
+    print('%i hot pixel maps in %1.1f s: %i to %i pixels'%(len(hp), time.time() - t0, min(counts, default=0), max(counts, default=0)))
@@ -0,0 +1,121 @@
+'''
+ Predictive exposure solver.
+ The 8-bit metering frame is modelled as value = black + k * exposure * gain_factor, clipped at 255.
+ From the full histogram of the sky region (including the saturated bin and the black level) we predict
+ the histogram for any other exposure/gain and solve for the pair that takes the frame to the target.
+
+   hist = GetHistogram(sky_pixels)
+   exposure, gain, predicted = PredictExposure(hist, exposure, gain, target=150)
+'''
+
+import numpy as np
+
+from allsky.config import ZWO_EXPMAX, ZWO_EXPMIN
+
+SATURATION = 255
+VALUES = np.arange(SATURATION+1, dtype=np.float64)
+
+def GainFactor(gain):
+  ''' Linear amplification for a ZWO gain value (gain is given in units of 0.1 dB) '''
+  return 10**(gain/200.)
+
+def GainFromFactor(factor):
+  ''' ZWO gain value for a linear amplification '''
+  return 200.*np.log10(factor)
+
+def GetHistogram(pixels):
+  ''' Histogram of an 8-bit array (all the bins from 0 to 255) '''
+  return np.bincount(np.asarray(pixels, dtype=np.uint8).ravel(), minlength=SATURATION+1)
+
+def GetBlackLevel(hist, percentile=0.1, maxblack=16):
+  ''' Estimate the black level from the low tail of the histogram (bounded, so bright scenes do not fake it) '''
+  cumulative = np.cumsum(hist)
+  black = np.searchsorted(cumulative, cumulative[-1]*percentile/100.)
+  return float(min(black, maxblack))
+
+def GetSaturatedFraction(hist):
+  ''' Fraction of saturated values '''
+  return hist[SATURATION] / hist.sum()
+
+def HistogramValue(hist, method='average', values=VALUES):
+  ''' Mean or median of a histogram, with the values of each bin given by [values] '''
+  if method.lower() == 'median':
+    cumulative = np.cumsum(hist)
+    total = cumulative[-1]
+    lo = np.searchsorted(cumulative, (total+1)//2)
+    hi = np.searchsorted(cumulative, total//2 + 1)
+    return (values[lo] + values[hi])/2.
+  return np.dot(hist, values) / hist.sum()
+
+def PredictValues(scale, black):
+  ''' Predicted value of each histogram bin when the signal is multiplied by [scale]
+      Saturated pixels are at least at 255, so their prediction is a lower bound
+  '''
+  values = black + (VALUES - black)*scale
+  values[values < 0] = 0
+  values[values > SATURATION] = SATURATION
+  return values
+
+def PredictSaturatedFraction(hist, scale, black):
+  ''' Predicted fraction of saturated pixels when the signal is multiplied by [scale] '''
+  saturated = PredictValues(scale, black) >= SATURATION
+  if scale < 1: saturated[SATURATION] = False # we do not know by how much they were saturated... assume the best case
+  return hist[saturated].sum() / hist.sum()
+
+def DesaturationScale(excess, maxstep=64.):
+  ''' Scale to apply when too many pixels are saturated: we do not know their value, so the step grows with the excess of saturated pixels '''
+  return max(np.exp(-4.*excess), 1./maxstep)
+
+def SolveScale(hist, target, method='average', black=None, frac_saturated=None, maxstep=64., precision=1e-3):
+  ''' Solve for the scale factor of the signal that takes the histogram value to the target
+      If frac_saturated is given, the scale is also bound so the predicted fraction of saturated pixels is below it.
+      If more than frac_saturated (or half, if not given) of the pixels are saturated, the prediction is just a lower bound
+      and the scale is also bound by DesaturationScale.
+      The scale is bound to [1/maxstep, maxstep] per iteration, so the overshoot is bounded for bad models.
+  '''
+  if black is None: black = GetBlackLevel(hist)
+  target = min(float(target), SATURATION - 1.)
+
+  # Value and saturation are monotonic with the scale --> bisection in log scale
+  def bisect(func):
+    lo, hi = -np.log(maxstep), np.log(maxstep)
+    if func(np.exp(hi)): return maxstep
+    if not func(np.exp(lo)): return 1./maxstep
+    while hi - lo > precision:
+      mid = (lo + hi)/2.
+      if func(np.exp(mid)): lo = mid
+      else: hi = mid
+    return np.exp(lo)
+
+  scale = bisect(lambda s: HistogramValue(hist, method, PredictValues(s, black)) <= target)
+  if frac_saturated is not None:
+    scale = min(scale, bisect(lambda s: PredictSaturatedFraction(hist, s, black) <= frac_saturated))
+  excess = GetSaturatedFraction(hist) - (frac_saturated if frac_saturated is not None else 0.5)
+  if excess > 0:
+    scale = min(scale, DesaturationScale(excess, maxstep))
+  return scale
+
+def PredictExposure(hist, exposure, gain, target=150, method='average', black=None, frac_saturated=None, max_gain=None, min_gain=None, maxstep=64.):
+  ''' Predict the exposure (in us) and gain that take the histogram to the target
+      The black level can be given (e.g. from the pixels out of the sky circle); if not, it is estimated from the histogram
+      The gain is only changed if max_gain (to go beyond the maximum exposure) or min_gain (to go below the minimum exposure) are given
+      Returns exposure, gain and the predicted value
+  '''
+  if black is None: black = GetBlackLevel(hist)
+  scale = SolveScale(hist, target, method, black, frac_saturated, maxstep)
+
+  # Total signal = exposure * gain factor... put it in the exposure first, then in the gain
+  signal = exposure * GainFactor(gain) * scale
+  newexp = signal / GainFactor(gain)
+  newgain = gain
+  if newexp > ZWO_EXPMAX*1e6 and max_gain is not None and max_gain > gain:
+    newgain = min(max_gain, int(np.ceil(GainFromFactor(signal/(ZWO_EXPMAX*1e6)))))
+  elif newexp < ZWO_EXPMIN*1e6 and min_gain is not None and min_gain < gain:
+    newgain = max(min_gain, int(np.floor(GainFromFactor(signal/(ZWO_EXPMIN*1e6)))))
+  newexp = signal / GainFactor(newgain)
+  newexp = int(min(max(newexp, ZWO_EXPMIN*1e6), ZWO_EXPMAX*1e6))
+
+  # Predicted value with the final (clamped) exposure and gain
+  scale = newexp * GainFactor(newgain) / (exposure * GainFactor(gain))
+  predicted = HistogramValue(hist, method, PredictValues(scale, black))
+  return newexp, newgain, predicted
@@ -0,0 +1,209 @@
+'''
+ Image processing for RAW16 (Bayer) frames: normalization, debayer, white balance, hot pixels and conversion to 8-bit.
+ The per-pixel steps are lookup tables (uint16 --> uint16/uint8) built from the frame range and channel histograms,
+ applied into working buffers that are reused between frames (one set per thread), so a frame makes no full-frame
+ float temporaries. The output is bit-identical to the plain float64 arithmetic.
+'''
+
+import threading
+import numpy as np
+import cv2
+from allsky.config import IMGPROC_MEMORY_BUDGET
+
+# ASI bayer pattern (ASI_BAYER_RG, ASI_BAYER_BG, ASI_BAYER_GR, ASI_BAYER_GB) --> cv2 code to get a BGR image
+BAYER_CODES = {0: cv2.COLOR_BAYER_RG2RGB, 1: cv2.COLOR_BAYER_BG2RGB, 2: cv2.COLOR_BAYER_GR2RGB, 3: cv2.COLOR_BAYER_GB2RGB}
+
+# Tiled mode: extra rows the debayer needs around a band (even, to keep the Bayer pattern), and working bytes per
+# pixel of a band (difference, normalized, debayered, balanced and filtered images, plus the indexing temporaries)
+DEBAYER_HALO = 2
+TILE_BYTES_PER_PIXEL = 26
+
+_local = threading.local()
+
+def get_buffer(name, shape, dtype):
+    ''' Working array kept between frames (per thread); reallocated only if the shape or type change '''
+    buffers = _local.__dict__.setdefault('buffers', {})
+    buf = buffers.get(name)
+    if buf is None or buf.shape != tuple(shape) or buf.dtype != dtype:
+        buf = buffers[name] = np.empty(shape, dtype=dtype)
+    return buf
+
+def apply_lut(lut, img, out):
+    ''' out = lut[img]; the indexing only makes a temporary of out's size (np.take would cast img to intp) '''
+    out[...] = lut[img]
+    return out
+
+def histogram_median(hist):
+    ''' Median (as np.median: mean of the two central values for an even count) from the histogram of integer values '''
+    cumulative = np.cumsum(hist)
+    n = int(cumulative[-1])
+    low = np.searchsorted(cumulative, (n - 1)//2 + 1)
+    high = np.searchsorted(cumulative, n//2 + 1)
+    return (low + high) / 2.
+
+def channel_histogram(img, channel):
+    ''' Histogram of the values (0 to 65535) of a channel of a uint16 image, without copying the channel '''
+    return cv2.calcHist([img], [channel], None, [65536], [0, 65536]).ravel().astype(np.int64)
+
+def white_balance_luts(hists):
+    ''' Lookup tables (uint16 --> uint16) scaling the median of each channel (from its histogram) to 32768 '''
+    levels = np.arange(65536, dtype=np.uint16)
+    luts = []
+    for hist in hists:
+        scale = 32768.0 / histogram_median(hist)
+        luts.append(np.clip(levels * scale, 0, 65535).astype(np.uint16))
+    return luts
+
+def white_balance(img, out=None):
+    ''' Scale each channel of a uint16 image so its median is 32768 '''
+    if out is None: out = np.empty_like(img)
+    for i, lut in enumerate(white_balance_luts([channel_histogram(img, c) for c in range(3)])):
+        apply_lut(lut, img[:, :, i], out[:, :, i])
+    return out
+
+def remove_hot_pixels(img, kernel_size=3, out=None):
+    median_filtered = cv2.medianBlur(img, kernel_size, dst=out)
+    return median_filtered
+
+def normalize_data(data, out=None, low=None, high=None, work=None):
+    ''' (data - min) / (max - min) * 65535 as uint16, with the arithmetic of the data type: a lookup table for
+        uint16 frames, in place float32 operations in a working buffer (work) for float32 (dark corrected) frames.
+        The range can be given, to normalize a part of a frame as the whole '''
+    if out is None: out = np.empty(data.shape, dtype=np.uint16)
+    if low is None: low, high = data.min(), data.max()
+    if data.dtype.kind == 'u' and data.dtype.itemsize == 2:
+        levels = np.arange(int(low), int(high) + 1).astype(np.uint16)
+        lut = np.zeros(65536, dtype=np.uint16)
+        lut[int(low):int(high) + 1] = ((levels - low) / (high - low) * 65535).astype(np.uint16)
+        apply_lut(lut, data, out)
+    elif data.dtype == np.float32:
+        buf = get_buffer('normalize', data.shape, np.float32) if work is None else work
+        np.subtract(data, low, out=buf)
+        np.divide(buf, high - low, out=buf)
+        np.multiply(buf, 65535, out=buf)
+        np.copyto(out, buf, casting='unsafe')
+    else:
+        out[...] = ((data - low) / (high - low) * 65535).astype(np.uint16)
+    return out
+
+def correct_hot_pixels(data, indices, row0=0, height=None):
+    ''' Replace the listed pixels (flat indices) of a RAW (Bayer) frame, in place, by the median of their four
+        neighbours of the same colour (two pixels away); the cost only depends on the number of pixels.
+        data can be the rows of a frame of the given height from row0 on (the neighbours must be in it) '''
+    if len(indices) == 0: return data
+    width = data.shape[1]
+    if height is None: height = data.shape[0]
+    rows, cols = np.divmod(indices.astype(np.intp), width)
+    up = np.where(rows >= 2, rows - 2, rows + 2) - row0
+    down = np.where(rows < height - 2, rows + 2, rows - 2) - row0
+    left = np.where(cols >= 2, cols - 2, cols + 2)
+    right = np.where(cols < width - 2, cols + 2, cols - 2)
+    rows -= row0
+    neighbours = np.stack([data[up, cols], data[down, cols], data[rows, left], data[rows, right]])
+    data[rows, cols] = np.median(neighbours, axis=0)
+    return data
+
+def debayer_data(data, bayer=0, hotpixels=None):
+    ''' Normalize, debayer, white balance and remove hot pixels of a RAW frame; returns an 8-bit BGR image.
+        With a hot pixel map (flat indices) only those pixels are fixed, before debayering; without it the whole
+        image is median filtered '''
+    shape = data.shape + (3,)
+
+    # Normalize the data to the range 0-65535 (16-bit)
+    data_normalized = normalize_data(data, get_buffer('normalized', data.shape, np.uint16))
+    if hotpixels is not None:
+        correct_hot_pixels(data_normalized, hotpixels)
+
+    # Debayer the image
+    debayered_image = cv2.cvtColor(data_normalized, BAYER_CODES[bayer], dst=get_buffer('debayered', shape, np.uint16))
+
+    # White balance, then convert to 8-bit (v/256 for uint16 is v >> 8), fused in a single table per channel
+    luts = white_balance_luts([channel_histogram(debayered_image, i) for i in range(3)])
+    image_8bit = np.empty(shape, dtype=np.uint8)
+    if hotpixels is not None:
+        for i, lut in enumerate(luts):
+            apply_lut((lut >> 8).astype(np.uint8), debayered_image[:, :, i], image_8bit[:, :, i])
+        return image_8bit
+
+    # ... or white balance, remove hot pixels (median filter of the 16-bit image) and convert to 8-bit
+    balanced_image = get_buffer('balanced', shape, np.uint16)
+    for i, lut in enumerate(luts):
+        apply_lut(lut, debayered_image[:, :, i], balanced_image[:, :, i])
+    filtered_image = remove_hot_pixels(balanced_image, out=get_buffer('filtered', shape, np.uint16))
+    np.right_shift(filtered_image, 8, out=image_8bit, casting='unsafe')
+    return image_8bit
+
+
+def debayer_band(light, dark, r0, r1, margin, low, high, hotpixels, bayer, buffers):
+    ''' Debayered (uint16) rows r0 - margin to r1 + margin of a frame (light - dark), normalized with the range of the
+        whole frame; returns the image and its first row. Only the rows the debayer and hot pixels need are read '''
+    height, width = light.shape
+    start = max(0, r0 - margin - DEBAYER_HALO) // 2 * 2
+    end = min(height, r1 + margin + DEBAYER_HALO)
+    # The hot pixels take their neighbours two rows away
+    first, last = (max(0, start - 2), min(height, end + 2)) if hotpixels is not None else (start, end)
+    n = last - first
+    if dark is None:
+        data = light[first:last]
+    else:
+        data = np.subtract(light[first:last], dark[first:last], out=buffers['difference'][:n])
+    normalized = normalize_data(data, buffers['normalized'][:n], low, high, work=None if dark is None else data)
+    if hotpixels is not None:
+        indices, rows = hotpixels
+        band = (rows >= start) & (rows < end)
+        correct_hot_pixels(normalized, indices[band], first, height)
+    image = cv2.cvtColor(normalized[start-first:end-first], BAYER_CODES[bayer], dst=buffers['debayered'][:end-start])
+    top = max(0, r0 - margin)
+    return image[top-start:min(height, r1 + margin)-start], top
+
+def debayer_tiled(light, dark=None, bayer=0, hotpixels=None, memory=IMGPROC_MEMORY_BUDGET):
+    ''' debayer_data(light - dark) in bands of rows, so the working memory is about memory bytes (plus the 8-bit
+        output), with three passes: the range of the frame, the histograms of the debayered channels and the output.
+        Each band takes the halo rows that the hot pixels, the debayer and the median filter need, so the output is
+        bit-identical to the untiled path '''
+    height, width = light.shape
+    rows = max(8, int(memory // (TILE_BYTES_PER_PIXEL * width)) // 2 * 2)
+    bands = [(r0, min(height, r0 + rows)) for r0 in range(0, height, rows)]
+    margin = 0 if hotpixels is not None else 1 # median filter 3x3
+    extra = 2*(margin + DEBAYER_HALO + 3)
+    buffers = {'difference': np.empty((rows + extra, width), dtype=np.float32) if dark is not None else None,
+               'normalized': np.empty((rows + extra, width), dtype=np.uint16),
+               'debayered': np.empty((rows + extra, width, 3), dtype=np.uint16)}
+    if hotpixels is not None:
+        hotpixels = (hotpixels, hotpixels.astype(np.intp) // width)
+
+    # Range of the (dark corrected) frame
+    if dark is None:
+        low, high = light.min(), light.max()
+    else:
+        low = high = None
+        for r0, r1 in bands:
+            difference = np.subtract(light[r0:r1], dark[r0:r1], out=buffers['difference'][:r1-r0])
+            low = difference.min() if low is None else min(low, difference.min())
+            high = difference.max() if high is None else max(high, difference.max())
+
+    # Channel histograms of the debayered frame --> white balance
+    hists = np.zeros((3, 65536), dtype=np.int64)
+    for r0, r1 in bands:
+        image, top = debayer_band(light, dark, r0, r1, 0, low, high, hotpixels, bayer, buffers)
+        for i in range(3): hists[i] += channel_histogram(image, i)
+    luts = white_balance_luts(hists)
+
+    image_8bit = np.empty((height, width, 3), dtype=np.uint8)
+    if hotpixels is not None:
+        luts = [(lut >> 8).astype(np.uint8) for lut in luts]
+    else:
+        balanced_image = np.empty((rows + 2*margin, width, 3), dtype=np.uint16)
+        filtered_image = np.empty((rows + 2*margin, width, 3), dtype=np.uint16)
+    for r0, r1 in bands:
+        image, top = debayer_band(light, dark, r0, r1, margin, low, high, hotpixels, bayer, buffers)
+        if hotpixels is not None:
+            for i, lut in enumerate(luts):
+                apply_lut(lut, image[:, :, i], image_8bit[r0:r1, :, i])
+            continue
+        n = len(image)
+        for i, lut in enumerate(luts):
+            apply_lut(lut, image[:, :, i], balanced_image[:n, :, i])
+        filtered = remove_hot_pixels(balanced_image[:n], out=filtered_image[:n])
+        np.right_shift(filtered[r0-top:r1-top], 8, out=image_8bit[r0:r1], casting='unsafe')
+    return image_8bit
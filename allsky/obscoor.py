@@ -1,35 +1,202 @@
 '''
  Class to get current time and coordinates for the observatory, sunset, sunrise and other space-time features
-
+ astropy, astroplan, ephem and pytz are imported on first use, so importing this module (and zwo) is fast
 '''
 
 
-import time, datetime
-import pytz
-import astroplan
-import astropy.units as u
-from astropy.time import Time
-import ephem
-import matplotlib.pyplot as plt
+import os, time, datetime, bisect
 import numpy as np
 
-from allsky.config import CERECEDA_ALLSKY_LAT, CERECEDA_ALLSKY_LON
+from allsky.config import CERECEDA_ALLSKY_LAT, CERECEDA_ALLSKY_LON, OBS_TIMELINE_STEP, OBS_TIMELINE_BEFORE, OBS_TIMELINE_AFTER, OBS_BATCH_STEP, OBS_EPHEM_STEP, OBS_EPHEM_SPAN
+from allsky.config import IERS_OFFLINE, IERS_A_FILE, IERS_MAX_AGE, IERS_DEGRADED
+from allsky.timing import timed
+
+def ConfigureIERS(offline=IERS_OFFLINE, filename=IERS_A_FILE, max_age=IERS_MAX_AGE, degraded=IERS_DEGRADED):
+  ''' Offline mode for the IERS tables: no downloads (nor any other network access from astropy), local or bundled IERS-A table.
+      Returns the age of the table in days (None if online) '''
+  if not offline: return None
+  from astropy.utils import iers
+  from astropy.utils.data import conf as dataconf
+  from astropy.time import Time
+  iers.conf.auto_download = False
+  iers.conf.auto_max_age = None # otherwise old predictions raise an error even without downloads; see max_age
+  iers.conf.iers_degraded_accuracy = degraded
+  dataconf.allow_internet = False
+  if filename is not None and os.path.isfile(filename):
+    iers.earth_orientation_table.set(iers.IERS_A.open(filename))
+  table = iers.earth_orientation_table.get()
+  age = Time.now().mjd - table.meta.get('predictive_mjd', table['MJD'][-1].value)
+  if age > max_age:
+    print('WARNING: the IERS table is %i days old, update %s'%(age, filename))
+  return age
+
+# Sky phases, by sun altitude
+DAY = 0          # sun above the horizon
+TWILIGHT = 1     # civil twilight and first half of the nautical twilight: 0 to -12 deg
+NAUTICAL = 2     # -12 to -18 deg
+ASTRONOMICAL = 3 # below -18 deg
+PHASE_NAMES = ['day', 'twilight', 'nautical', 'astronomical']
+PHASE_LIMITS = [-18, -12, 0] # deg
+
+def PhaseFromAltitude(alt):
+  ''' Sky phase for a sun altitude in deg (or an array of them) '''
+  return 3 - np.digitize(alt, PHASE_LIMITS)
+
+def ToUnix(some_time=None):
+  ''' Unix time from None (now), a unix time, an astropy Time or anything that Time takes '''
+  if some_time is None: return time.time()
+  if isinstance(some_time, (int, float)): return float(some_time)
+  from astropy.time import Time
+  if not isinstance(some_time, Time): some_time = Time(some_time)
+  return float(some_time.unix)
+
+def ToUnixArray(times):
+  ''' Array of unix times from an astropy Time or an array of unix times '''
+  if hasattr(times, 'unix'): return np.atleast_1d(times.unix)
+  return np.atleast_1d(np.asarray(times, dtype=float))
+
+def SunAltitude(obs, times, step=OBS_BATCH_STEP):
+  ''' Sun altitude in deg for an array of times.
+      The exact position is computed on a grid of step seconds and the hour angle and declination are interpolated
+      in between (error ~1e-3 deg for a 6 h grid), so large arrays need a single small astropy call '''
+  from astropy.time import Time
+  unix = ToUnixArray(times)
+  grid = np.arange(unix.min(), unix.max() + step, step)
+  if grid.size >= unix.size:
+    return obs.sun_altaz(Time(unix, format='unix')).alt.deg
+  altaz = obs.sun_altaz(Time(grid, format='unix'))
+  alt, az = altaz.alt.rad, altaz.az.rad
+  lat = obs.location.lat.rad
+  dec = np.arcsin(np.sin(lat)*np.sin(alt) + np.cos(lat)*np.cos(alt)*np.cos(az))
+  ha = np.arctan2(-np.sin(az)*np.cos(alt), np.cos(lat)*np.sin(alt) - np.sin(lat)*np.cos(alt)*np.cos(az))
+  ha = np.interp(unix, grid, np.unwrap(ha))
+  dec = np.interp(unix, grid, dec)
+  return np.degrees(np.arcsin(np.sin(lat)*np.sin(dec) + np.cos(lat)*np.cos(dec)*np.cos(ha)))
+
+def ClassifyPhases(obs, times, step=OBS_BATCH_STEP):
+  ''' Sky phase (DAY, TWILIGHT, NAUTICAL or ASTRONOMICAL) for an array of times '''
+  return PhaseFromAltitude(SunAltitude(obs, times, step))
+
+class SkyTimeline:
+  ''' Sun events (sunset, sunrise, twilights) in a window around a given time, from the sun altitude on a grid;
+      the phase queries are binary searches on the sorted event times '''
+  def __init__(self, obs, t=None, step=OBS_TIMELINE_STEP, before=OBS_TIMELINE_BEFORE, after=OBS_TIMELINE_AFTER):
+    from astropy.time import Time
+    t = ToUnix(t)
+    self.start, self.end = t - before, t + after
+    self.grid = np.arange(self.start, self.end + step, step)
+    self.alt = obs.sun_altaz(Time(self.grid, format='unix')).alt.deg
+    # Crossings of each limit, linearly interpolated between grid points (error of a few seconds)
+    events, sunsets, sunrises = [], [], []
+    for limit in PHASE_LIMITS:
+      a = self.alt - limit
+      idx = np.nonzero((a[:-1] >= 0) != (a[1:] >= 0))[0]
+      tcross = self.grid[idx] + step * a[idx] / (a[idx] - a[idx+1])
+      events += tcross.tolist()
+      if limit == 0:
+        sunsets += tcross[a[idx] >= 0].tolist()
+        sunrises += tcross[a[idx] < 0].tolist()
+    self.times = sorted(events)
+    self.sunsets = sorted(sunsets)
+    self.sunrises = sorted(sunrises)
+    # Phase before the first event and after each one (evaluated half way to the next event)
+    edges = [self.start] + self.times + [self.end]
+    mid = [(t0 + t1) / 2 for t0, t1 in zip(edges[:-1], edges[1:])]
+    self.phases = PhaseFromAltitude(np.interp(mid, self.grid, self.alt)).tolist()
+
+  def IsValid(self, t, margin=OBS_TIMELINE_BEFORE):
+    ''' The window covers t, with some margin ahead for the next events '''
+    return self.start <= t <= self.end - margin
+
+  def GetPhase(self, t):
+    return self.phases[bisect.bisect_right(self.times, t)]
+
+  def GetNextSunset(self, t):
+    i = bisect.bisect_right(self.sunsets, t)
+    return self.sunsets[i] if i < len(self.sunsets) else None
+
+  def GetLastSunrise(self, t):
+    i = bisect.bisect_right(self.sunrises, t)
+    return self.sunrises[i-1] if i > 0 else None
+
+PLANETS = ["Mercury", "Venus", "Mars", "Jupiter", "Saturn", "Uranus", "Neptune"]
+
+class EphemerisCache:
+  ''' Moon (phase, alt, az) and planets (alt, az, mag) computed with ephem on a grid of step seconds and linearly
+      interpolated in between '''
+  def __init__(self, ephemobs, t=None, step=OBS_EPHEM_STEP, span=OBS_EPHEM_SPAN):
+    import ephem
+    t = ToUnix(t)
+    self.start, self.end = t - step, t + span
+    self.grid = np.arange(self.start, self.end + step, step)
+    self.bodies = {name: ephem.__dict__[name]() for name in ['Moon'] + PLANETS}
+    obs = ephem.Observer()
+    obs.lat, obs.lon, obs.elevation = ephemobs.lat, ephemobs.lon, ephemobs.elevation
+    values = {name: np.empty((len(self.grid), 3)) for name in self.bodies}
+    moonphase = np.empty(len(self.grid))
+    epoch = float(ephem.Date('1970/1/1')) # ephem dates are days since 1899/12/31 12:00 UT
+    for i, ti in enumerate(self.grid):
+      obs.date = ephem.Date(epoch + ti/86400.)
+      for name, body in self.bodies.items():
+        body.compute(obs)
+        values[name][i] = body.alt, body.az, body.mag
+      moonphase[i] = self.bodies['Moon'].moon_phase
+    for v in values.values(): v[:, 1] = np.unwrap(v[:, 1])
+    self.values = values
+    self.moonphase = moonphase
+
+  def IsValid(self, t):
+    return self.start <= t <= self.end
+
+  def Get(self, name, t):
+    ''' alt (deg), az (deg) and magnitude of a body at unix time t '''
+    v = self.values[name]
+    alt, az, mag = [np.interp(t, self.grid, v[:, i]) for i in range(3)]
+    return np.degrees(alt), np.degrees(az) % 360, mag
+
+  def GetMoonPhase(self, t):
+    ''' Illuminated fraction of the moon, in % '''
+    return np.interp(t, self.grid, self.moonphase)*100
 
 class obscoor:
   def __init__(self, latitude=CERECEDA_ALLSKY_LAT, longitude=CERECEDA_ALLSKY_LON):
+    self.iers_age = None
     self.latitude = latitude
     self.longitude = longitude
     self.t0 = time.time()
     self.timezone = 'Europe/Madrid'
-    self.tz = pytz.timezone(self.timezone)
-    self.obs = astroplan.Observer(longitude=longitude*u.deg, latitude=latitude*u.deg, elevation=700*u.m, name='Cereceda', timezone=self.timezone)
     self.std_format = "%d/%m/%Y %H:%M:%S %Z"
-    self.moon = ephem.Moon()
-    self.ephemobs = ephem.Observer()
-    self.ephemobs.lat, self.ephemobs.lon = str(CERECEDA_ALLSKY_LAT), str(CERECEDA_ALLSKY_LON)
-    self.moon.compute(self.ephemobs)
+    self._obs = None
+    self._ephemobs = None
+    self.timeline = None
+    self.ephemeris = None
+
+  @property
+  def obs(self):
+    ''' astroplan Observer -- created (and the IERS tables configured) on first use '''
+    if self._obs is None:
+      import astroplan
+      import astropy.units as u
+      self.iers_age = ConfigureIERS()
+      self._obs = astroplan.Observer(longitude=self.longitude*u.deg, latitude=self.latitude*u.deg, elevation=700*u.m, name='Cereceda', timezone=self.timezone)
+    return self._obs
+
+  @property
+  def ephemobs(self):
+    ''' ephem Observer '''
+    if self._ephemobs is None:
+      import ephem
+      self._ephemobs = ephem.Observer()
+      self._ephemobs.lat, self._ephemobs.lon = str(self.latitude), str(self.longitude)
+    return self._ephemobs
+
+  @property
+  def tz(self):
+    import pytz
+    return pytz.timezone(self.timezone)
 
   def GetAstroTimeNow(self, utc=False):
+    from astropy.time import Time
     time = Time(datetime.datetime.utcnow()) if utc else Time(datetime.datetime.now())
     return time
 
@@ -47,10 +214,29 @@ class obscoor:
   def GetDeltaTime(self):
     return time.time() - self.t0
 
-  def IsNight(self):
-    return self.obs.is_night(self.GetAstroTimeNow(utc=True))
+  def GetTimeline(self, some_time=None):
+    ''' Sky-phase timeline covering some_time (now by default) -- recomputed when it expires '''
+    t = ToUnix(some_time)
+    if self.timeline is None or not self.timeline.IsValid(t):
+      self.timeline = SkyTimeline(self.obs, t)
+    return self.timeline
+
+  def GetPhase(self, some_time=None):
+    ''' Sky phase (DAY, TWILIGHT, NAUTICAL or ASTRONOMICAL) at some_time (now by default) '''
+    t = ToUnix(some_time)
+    return self.GetTimeline(t).GetPhase(t)
+
+  def ClassifyPhases(self, times):
+    ''' Sky phases for an array of times (astropy Time or unix times), e.g. for planning '''
+    return ClassifyPhases(self.obs, times)
+
+  @timed('obscoor.IsNight')
+  def IsNight(self, some_time=None):
+    return self.GetPhase(some_time) != DAY
 
   def GetSunsetTime(self, some_time=None):
+    import pytz
+    from astropy.time import Time
     if some_time is None: some_time = (self.GetAstroTimeNow())
     elif not isinstance(some_time, Time): some_time = Time(some_time) 
     sunset = self.obs.sun_set_time(some_time).datetime
@@ -59,6 +245,8 @@ class obscoor:
     return sunset
 
   def GetSunriseTime(self, some_time=None):
+    import pytz
+    from astropy.time import Time
     if some_time is None: some_time = (self.GetAstroTimeNow())
     elif not isinstance(some_time, Time): some_time = Time(some_time) 
     sunrise = self.obs.sun_rise_time(some_time).datetime
@@ -66,60 +254,59 @@ class obscoor:
     sunrise = sunrise.astimezone(self.tz)
     return sunrise
 
+  @timed('obscoor.IsDayButCloseToSunsetSunrise')
   def IsDayButCloseToSunsetSunrise(self, some_time=None, delta_hours=1):
     ''' Check if it is daytime but we are within delta_hours hours from sunset or sunrise '''
-    if some_time is None: some_time = (self.GetAstroTimeNow())
-    elif not isinstance(some_time, Time): some_time = Time(some_time)
-    sunset = self.GetSunsetTime(some_time)
-    sunrise = self.GetSunriseTime(some_time)
-    if some_time < sunset and some_time > sunset - delta_hours*datetime.timedelta(hours=1): return True
-    if some_time > sunrise and some_time < sunrise + delta_hours*datetime.timedelta(hours=1): return True
+    t = ToUnix(some_time)
+    timeline = self.GetTimeline(t)
+    if timeline.GetPhase(t) != DAY: return False
+    sunset = timeline.GetNextSunset(t)
+    sunrise = timeline.GetLastSunrise(t)
+    if sunset is not None and sunset - t < delta_hours*3600: return True
+    if sunrise is not None and t - sunrise < delta_hours*3600: return True
     return False
 
-  def IsAstronomicalTwilight(self):
-    current_time = Time.now()
-
-    # Calculate the evening and morning astronomical twilight times for the current date
-    evening_astronomical_twilight = self.obs.twilight_evening_astronomical(current_time, which='nearest')
-    morning_astronomical_twilight = self.obs.twilight_morning_astronomical(current_time, which='nearest')
+  @timed('obscoor.IsAstronomicalTwilight')
+  def IsAstronomicalTwilight(self, some_time=None):
+    ''' Sun below -18 deg '''
+    return self.GetPhase(some_time) == ASTRONOMICAL
 
-    # Check if the current time is between the evening and morning astronomical twilight times
-    if evening_astronomical_twilight < current_time < morning_astronomical_twilight:
-        return True
-    else:
-        return False
+  @timed('obscoor.IsNauticalTwilight')
+  def IsNauticalTwilight(self, some_time=None):
+    ''' Sun between -12 and -18 deg '''
+    return self.GetPhase(some_time) == NAUTICAL
 
-  def IsNauticalTwilight(self):
-    current_time = Time.now()
+  def GetEphemeris(self, some_time=None):
+    ''' Moon and planets cache covering some_time (now by default) -- recomputed when it expires '''
+    t = ToUnix(some_time)
+    if self.ephemeris is None or not self.ephemeris.IsValid(t):
+      self.ephemeris = EphemerisCache(self.ephemobs, t)
+    return self.ephemeris
 
-    # Calculate the evening and morning nautical twilight times for the current date
-    evening_nautical_twilight = self.obs.twilight_evening_nautical(current_time, which='nearest')
-    morning_nautical_twilight = self.obs.twilight_morning_nautical(current_time, which='nearest')
+  def GetMoonPhase(self, some_time=None):
+    t = ToUnix(some_time)
+    return float(self.GetEphemeris(t).GetMoonPhase(t))
 
-    # Check if the current time is between the evening and morning nautical twilight times
-    if evening_nautical_twilight < current_time < morning_nautical_twilight and not self.IsAstronomicalTwilight():
-        return True
-    else:
-        return False
+  def GetMoonAltAz(self, some_time=None):
+    ''' Altitude and azimuth of the moon, in deg '''
+    t = ToUnix(some_time)
+    alt, az, mag = self.GetEphemeris(t).Get('Moon', t)
+    return float(alt), float(az)
 
-  def GetMoonPhase(self):
-    return self.moon.moon_phase*100
-
-  def GetVisiblePlanets(self):
-    # Get visible planets
-    planets = ["Mercury", "Venus", "Mars", "Jupiter", "Saturn", "Uranus", "Neptune"]
+  def GetVisiblePlanets(self, some_time=None):
+    ''' Planets above the horizon and brighter than magnitude 10 '''
+    t = ToUnix(some_time)
+    ephemeris = self.GetEphemeris(t)
     visible_planets = []
-
-    for planet_name in planets:
-        planet = ephem.__dict__[planet_name]()
-        planet.compute(self.ephemobs)
-
-        # Check if the planet is above the horizon and visible
-        if planet.alt > 0 and planet.mag < 10:
-            visible_planets.append(planet_name)
+    for planet_name in PLANETS:
+      alt, az, mag = ephemeris.Get(planet_name, t)
+      if alt > 0 and mag < 10:
+        visible_planets.append(planet_name)
     return visible_planets
 
 
+# Reference implementations with the astroplan solvers, one time at a time (see scripts/benchSkyPhase.py)
+
 def IsNight(obs, time):
   return obs.is_night(time)
 
@@ -136,28 +323,21 @@ def IsNauticalTwilight(obs, time):
   else: return False
 
 if __name__ == '__main__':
+  import matplotlib.pyplot as plt
   o = obscoor()
-  obs = o.obs
-  t = o.GetAstroTimeNow()
   print('Is day but close to sunset/sunrise: ', o.IsDayButCloseToSunsetSunrise())
   print('Now: ', o.GetTimeNow(), ' -- ' + 'Is night!' if o.IsNight() else 'is not night yet...')
   print('Sun set  time: ', o.GetSunsetTime().strftime(o.std_format)  )
   print('Sun rise time: ', o.GetSunriseTime().strftime(o.std_format)  )
   print('Moon phase: %1.1f'%(o.GetMoonPhase()) , '%')
   print('Visible planets: ', o.GetVisiblePlanets())
-  t = t - 12*u.hour
-  t0 = t.datetime.timestamp()
-  h = []; isnight = []; isastronomicaltwilight = []; isnauticaltwilight = []
-  for i in range(24*2):
-    t = t + 30*u.minute
-    h.append(t.datetime.timestamp() - t0)
-    isnight.append(IsNight(obs, t))
-    isastronomicaltwilight.append(IsAstronomicalTwilight(obs, t))
-    isnauticaltwilight.append(IsNauticalTwilight(obs, t))
-  # h --> time to float
-  plt.plot(h, isnight, label='is night')
-  plt.plot(h, isastronomicaltwilight, label='is astronomical twilight')
-  plt.plot(h, isnauticaltwilight, label='is nautical twilight')
+  # Phases for the next 24 hours, every minute
+  t0 = time.time() - 12*3600
+  h = np.arange(0, 24*3600, 60)
+  phases = o.ClassifyPhases(t0 + h)
+  plt.plot(h/3600, phases != DAY, label='is night')
+  plt.plot(h/3600, phases == ASTRONOMICAL, label='is astronomical twilight')
+  plt.plot(h/3600, phases == NAUTICAL, label='is nautical twilight')
+  plt.xlabel('hours since %s'%time.strftime('%d/%m/%Y %H:%M', time.localtime(t0)))
   plt.legend()
   plt.savefig('test.png')
-
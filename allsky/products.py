@@ -0,0 +1,119 @@
+'''
+ Content-addressed cache of processed products (calibrated frames, debayered images, jpegs, thumbnails).
+ A product is stored under the sha256 of its inputs: the identity of the input files (path, size, mtime) and the
+ parameters of the stage, or the key of the previous stage, so a stage is only recomputed when something it
+ depends on changed. The cache is bounded in bytes: the least recently used products are evicted first.
+
+   cache = GetProductCache()
+   key = Key('jpeg', FileIdentity(fitfile), params)
+   jpg = cache.Get(key, 'jpg')              # None if it is not cached
+   cache.PutFile(key, 'jpg', filename)
+   cache.Evict()                            # once in a while (e.g. after a batch)
+'''
+
+import os, json, time, hashlib, shutil
+import numpy as np
+
+from allsky.config import OUTPUT_PRODUCTS_DIR, PRODUCTS_BUDGET
+
+def FileIdentity(filename):
+  ''' Identity of a file (absolute path, size and modification time), None if it does not exist '''
+  if filename is None or not os.path.exists(filename): return None
+  st = os.stat(filename)
+  return [os.path.abspath(filename), st.st_size, st.st_mtime_ns]
+
+def Key(*parts):
+  ''' sha256 of the json of the parts (input identities, parameters and keys of previous stages) '''
+  return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+class ProductCache:
+  def __init__(self, path=OUTPUT_PRODUCTS_DIR, budget=PRODUCTS_BUDGET):
+    self.path = path
+    self.budget = budget
+    self.hits = 0
+    self.misses = 0
+
+  def Path(self, key, ext):
+    return os.path.join(self.path, key[:2], key + '.' + ext)
+
+  def Get(self, key, ext):
+    ''' Path of a cached product (and mark it as recently used), or None '''
+    filename = self.Path(key, ext)
+    if not os.path.isfile(filename):
+      self.misses += 1
+      return None
+    os.utime(filename)
+    self.hits += 1
+    return filename
+
+  def Put(self, key, ext, write):
+    ''' Store a product: write(filename) writes it to a temporary file, renamed when complete (atomic) '''
+    filename = self.Path(key, ext)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp = '%s.%i.tmp'%(filename, os.getpid())
+    write(temp)
+    os.replace(temp, filename)
+    return filename
+
+  def PutFile(self, key, ext, source):
+    return self.Put(key, ext, lambda temp: shutil.copyfile(source, temp))
+
+  def GetArray(self, key):
+    ''' Cached array (memory-mapped), or None '''
+    filename = self.Get(key, 'npy')
+    return None if filename is None else np.load(filename, mmap_mode='r')
+
+  def PutArray(self, key, data):
+    def Write(temp):
+      with open(temp, 'wb') as f: np.save(f, data)
+    return self.Put(key, 'npy', Write)
+
+  def Size(self):
+    ''' Products in the cache: [(last use, bytes, path)] '''
+    products = []
+    if not os.path.isdir(self.path): return products
+    for sub in os.scandir(self.path):
+      if not sub.is_dir(): continue
+      for entry in os.scandir(sub.path):
+        if entry.name.endswith('.tmp'): continue
+        st = entry.stat()
+        products.append((st.st_mtime, st.st_size, entry.path))
+    return products
+
+  def Evict(self, budget=None):
+    ''' Remove the least recently used products until the cache fits in budget bytes; returns the bytes freed '''
+    if budget is None: budget = self.budget
+    products = sorted(self.Size())
+    total = sum(p[1] for p in products)
+    freed = 0
+    for mtime, size, filename in products:
+      if total - freed <= budget: break
+      os.remove(filename)
+      freed += size
+    return freed
+
+  def Stats(self):
+    return {'hits': self.hits, 'misses': self.misses}
+
+
+# Cache shared by the processing functions
+cache = None
+
+def GetProductCache():
+  global cache
+  if cache is None: cache = ProductCache()
+  return cache
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser(description='Cache of processed products')
+  parser.add_argument('--path', default=OUTPUT_PRODUCTS_DIR, help='Cache folder')
+  parser.add_argument('--evict', type=float, default=None, metavar='MB', help='Evict the least recently used products down to MB')
+  args = parser.parse_args()
+
+  pc = ProductCache(args.path)
+  t0 = time.time()
+  if args.evict is not None:
+    print('Freed %1.1f MB'%(pc.Evict(args.evict*1024**2)/1024**2))
+  products = pc.Size()
+  print('%i products, %1.1f MB (%1.2f s)'%(len(products), sum(p[1] for p in products)/1024**2, time.time() - t0))
@@ -0,0 +1,173 @@
+'''
+Batch processing of the FITs of a night folder: dark subtraction (dark library), hot pixels, debayer, white balance
+and jpeg, for every frame, in a pool of processes. The processed frames are recorded in a manifest (NIGHT_MANIFEST,
+in the night folder), so an interrupted run goes on where it stopped. Optionally, the FITs are deleted once their
+jpeg is written, except the gain0 ones.
+With the product cache (--cache, see allsky.products), every stage (calibrated frame, debayered image, jpeg and
+thumbnail) is cached under the hash of its inputs, so a re-run (--redo) only recomputes the stages that changed.
+
+  >> python -m allsky.scripts.ProcessNight                       # latest night folder
+  >> python -m allsky.scripts.ProcessNight /path/to/2024-01-20 --workers 4 --delete
+  >> python -m allsky.scripts.ProcessNight /path/to/2024-01-20 --cache --redo
+'''
+
+import os, json, time, shutil, argparse
+from concurrent.futures import ProcessPoolExecutor
+from allsky.config import OUTPUT_IMAGES_DIR, NIGHT_WORKERS, NIGHT_MANIFEST, NIGHT_DELETE_FITS, NIGHT_KEEP_PREFIX, IMGPROC_TILED
+from allsky.config import NIGHT_USE_CACHE, NIGHT_CACHE_STAGES, NIGHT_THUMBNAIL_WIDTH, DARKS_MODEL_FILE, DARKS_HOTPIXELS_FILE
+from allsky.darklib import GetDarkLibrary
+from allsky.products import GetProductCache, FileIdentity, Key
+
+
+def load_manifest(path):
+    ''' Frames already processed in a night folder: name --> {'jpg', 'dark', 'time'} or {'error'} '''
+    manifest = os.path.join(path, NIGHT_MANIFEST)
+    if not os.path.isfile(manifest):
+        return {}
+    with open(manifest) as f:
+        return json.load(f)['frames']
+
+def save_manifest(path, frames):
+    ''' Write the manifest (atomic, so an interrupted run never leaves it half written) '''
+    manifest = os.path.join(path, NIGHT_MANIFEST)
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump({'updated': time.strftime('%Y-%m-%dT%H:%M:%S'), 'frames': frames}, f, indent=1)
+    os.replace(manifest + '.tmp', manifest)
+
+def list_frames(path):
+    return sorted(f for f in os.listdir(path) if f.lower().endswith(('.fit', '.fits')))
+
+def process_frame(imgpath, tiled=IMGPROC_TILED):
+    ''' Dark-correct (if there is a dark for it) and debayer a frame into a jpeg next to it; run in the workers.
+        With tiled, in bands of rows with bounded memory (same jpeg). A frame that fails (e.g. a truncated FITs)
+        is reported with its error instead of stopping the batch '''
+    from allsky.scripts.TakeDarks import dark_correct_img, debayer, dark_correct_debayer_tiled
+    t0 = time.time()
+    try:
+        if tiled:
+            jpg, dark = dark_correct_debayer_tiled(imgpath)
+        else:
+            corrected = dark_correct_img(imgpath)
+            jpg, dark = debayer(imgpath if corrected is None else corrected, outpath=imgpath), corrected is not None
+    except Exception as e:
+        return imgpath, {'error': '%s: %s'%(type(e).__name__, e)}
+    return imgpath, {'jpg': os.path.basename(jpg), 'dark': dark, 'time': round(time.time() - t0, 3)}
+
+def process_frame_cached(imgpath, tiled=IMGPROC_TILED, stages=NIGHT_CACHE_STAGES, thumbnail=NIGHT_THUMBNAIL_WIDTH):
+    ''' process_frame through the product cache: the key of each stage hashes its inputs (the light and dark files,
+        the hot pixel maps, the code of imgproc, the parameters) or the key of the previous stage, and a stage is only
+        computed if its product is not in the cache. The same products with and without tiled '''
+    import numpy as np
+    import cv2
+    from astropy.io import fits
+    from allsky import imgproc
+    from allsky.scripts.TakeDarks import get_dark_source, get_dark_data, get_hot_pixels
+    cache = GetProductCache()
+    t0 = time.time()
+    computed = []
+    try:
+        with fits.open(imgpath) as light_image:
+            header = light_image[0].header
+            source = get_dark_source(header)
+            dark_identity = None if source is None else (FileIdentity(DARKS_MODEL_FILE) + list(source[1:]) if source[0] == 'model' else FileIdentity(source[1]))
+            calibrated_key = Key('calibrated', FileIdentity(imgpath), dark_identity)
+            debayered_key = Key('debayered', calibrated_key, FileIdentity(DARKS_HOTPIXELS_FILE), FileIdentity(imgproc.__file__))
+            jpeg_key = Key('jpeg', debayered_key)
+            jpeg_output_path = os.path.splitext(imgpath)[0] + '.jpg'
+
+            cached = cache.Get(jpeg_key, 'jpg') if 'jpeg' in stages else None
+            if cached is not None:
+                shutil.copyfile(cached, jpeg_output_path)
+            else:
+                image = cache.GetArray(debayered_key) if 'debayered' in stages else None
+                if image is None:
+                    light_data = light_image[0].data
+                    hotpixels = get_hot_pixels(header, light_data.shape)
+                    if tiled:
+                        image = imgproc.debayer_tiled(light_data, get_dark_data(header), hotpixels=hotpixels)
+                    else:
+                        calibrated = light_data
+                        if source is not None:
+                            calibrated = cache.GetArray(calibrated_key) if 'calibrated' in stages else None
+                            if calibrated is None:
+                                calibrated = np.subtract(light_data, get_dark_data(header), dtype=np.float32)
+                                if 'calibrated' in stages: cache.PutArray(calibrated_key, calibrated)
+                                computed.append('calibrated')
+                        image = imgproc.debayer_data(calibrated, hotpixels=hotpixels)
+                    if 'debayered' in stages: cache.PutArray(debayered_key, image)
+                    computed.append('debayered')
+                cv2.imwrite(jpeg_output_path, image)
+                if 'jpeg' in stages: cache.PutFile(jpeg_key, 'jpg', jpeg_output_path)
+                computed.append('jpeg')
+
+        if thumbnail:
+            thumbnail_path = os.path.join(os.path.dirname(imgpath), 'thumbs', os.path.basename(jpeg_output_path))
+            os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+            thumbnail_key = Key('thumbnail', jpeg_key, thumbnail)
+            cached = cache.Get(thumbnail_key, 'jpg') if 'thumbnail' in stages else None
+            if cached is not None:
+                shutil.copyfile(cached, thumbnail_path)
+            else:
+                image = cv2.imread(jpeg_output_path)
+                height = round(image.shape[0] * thumbnail / image.shape[1])
+                cv2.imwrite(thumbnail_path, cv2.resize(image, (thumbnail, height), interpolation=cv2.INTER_AREA))
+                if 'thumbnail' in stages: cache.PutFile(thumbnail_key, 'jpg', thumbnail_path)
+                computed.append('thumbnail')
+    except Exception as e:
+        return imgpath, {'error': '%s: %s'%(type(e).__name__, e)}
+    return imgpath, {'jpg': os.path.basename(jpeg_output_path), 'dark': source is not None, 'time': round(time.time() - t0, 3), 'computed': computed}
+
+def process_night(path, workers=NIGHT_WORKERS, delete=NIGHT_DELETE_FITS, keep_prefix=NIGHT_KEEP_PREFIX, tiled=IMGPROC_TILED,
+                  use_cache=NIGHT_USE_CACHE, redo=False):
+    ''' Process all the FITs of a night folder not in its manifest (or that failed), or all of them with redo;
+        returns the number of frames processed '''
+    frames = load_manifest(path)
+    names = list_frames(path)
+    todo = [os.path.join(path, f) for f in names if redo or 'error' in frames.get(f, {'error': None})]
+    print('%s: %i frames to process (%i already done), %i processes'%(path, len(todo), len(names) - len(todo), workers))
+    if not todo:
+        return 0
+    GetDarkLibrary() # loaded (or scanned) once, before the workers are forked
+    t0 = time.time()
+    n, failed = 0, 0
+    computed = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for imgpath, result in pool.map(process_frame_cached if use_cache else process_frame, todo, [tiled]*len(todo)):
+            for stage in result.pop('computed', []):
+                computed[stage] = computed.get(stage, 0) + 1
+            name = os.path.basename(imgpath)
+            frames[name] = result
+            save_manifest(path, frames)
+            if 'error' in result:
+                print('  ERROR processing %s: %s'%(name, result['error']))
+                failed += 1
+            elif delete and not name.startswith(keep_prefix):
+                os.remove(imgpath)
+            n += 1
+            if n % 50 == 0:
+                print('  %i/%i frames, %1.2f frames/s'%(n, len(todo), n/(time.time() - t0)))
+    elapsed = time.time() - t0
+    print('Processed %i frames (%i failed) in %1.1f s: %1.2f frames/s'%(n, failed, elapsed, n/elapsed))
+    if use_cache:
+        print('Stages computed (the rest came from the product cache): %s'%(', '.join('%s %i'%x for x in computed.items()) or 'none'))
+        freed = GetProductCache().Evict()
+        if freed: print('Evicted %1.1f MB from the product cache'%(freed/1024**2))
+    return n
+
+def latest_night(directory=OUTPUT_IMAGES_DIR):
+    dirs = [os.path.join(directory, d) for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
+    return max(dirs, key=os.path.getctime) if dirs else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibrate and debayer the FITs of a night')
+    parser.add_argument('path', nargs='?', default=None, help='Night folder (the latest one by default)')
+    parser.add_argument('--workers', type=int, default=NIGHT_WORKERS, help='Number of processes')
+    parser.add_argument('--delete', action='store_true', default=NIGHT_DELETE_FITS, help='Delete the FITs (except %s) once processed'%NIGHT_KEEP_PREFIX)
+    parser.add_argument('--tiled', action='store_true', default=IMGPROC_TILED, help='Process the frames in bands of rows (bounded memory)')
+    parser.add_argument('--cache', action='store_true', default=NIGHT_USE_CACHE, help='Use the product cache')
+    parser.add_argument('--redo', action='store_true', help='Process again the frames in the manifest')
+    args = parser.parse_args()
+
+    path = args.path if args.path is not None else latest_night()
+    process_night(path, args.workers, args.delete, tiled=args.tiled, use_cache=args.cache, redo=args.redo)
@@ -1,6 +1,7 @@
-from allsky.config import TIME_INTERVAL_NIGHT, TIME_INTERVAL_DAY, OUTPUT_IMAGES_DIR
+from allsky.config import TIME_INTERVAL_NIGHT, TIME_INTERVAL_DAY, OUTPUT_IMAGES_DIR, TIMING_FILE, TIMING_TRACE_FILE
 
 from allsky.zwo import zwo
+from allsky.timing import timer
 import time, os
 
 # TODO: por la noche, sacar solo FITs... luego corregir y transformar los FITs en jpgs y borrar los originales (excepto por aquellos de gain=0, cada 2min)
@@ -19,14 +20,18 @@ def SetOutPathToday(cam=None):
   return outpath
 
 cam = zwo(verbose=1)
+cam.EnableBackgroundWriter()
+cam.SetPublishPath('/home/astroberry/AllSky/last.jpg')
 SetOutPathToday(cam)
 cam.SetOutName('pic')
+if TIMING_TRACE_FILE is not None: timer.EnableTrace()
 
 # Initialize with auto exp based on time of the day
 cam.Auto(target=120, tolerance=50, fix=True, log=True, startFrom='time')
 
 t0 = time.time()
 while True:
+  tcycle = time.time()
   dt = time.time() - t0
   SetOutPathToday(cam)
   cam.SetSufixTimeNow()
@@ -48,17 +53,17 @@ while True:
   elif cam.coor.IsNight() and not cam.coor.IsAstronomicalTwilight():
     if cam.verbose: print('Night time - civil/nautical twilight! Taking picture...')
     cam.Auto(forcegain=40, method='max', frac_saturated=0.07, fix=True, log=True, target=120, tolerance=50)
-    cam.Snap(format='jpeg', auto=True, recalculate_each_min=None)
-    if cam.GetExposureTime() > 1: # we need to get a .fit and apply a dark substraction
-      time.sleep(cam.GetExposureTime()/2)
-      cam.Snap(format='fit', auto=True, recalculate_each_min=None)
+    if cam.GetExposureTime() > 1: # we need to get a .fit and apply a dark substraction -- the jpeg comes from the same exposure
+      cam.Snap(format='fit+jpg', auto=True, recalculate_each_min=None)
+    else:
+      cam.Snap(format='jpeg', auto=True, recalculate_each_min=None)
 
   elif cam.coor.IsAstronomicalTwilight():
     if cam.verbose: print('Night time - astronomical twilight! Taking picture...')
     cam.Auto(forcegain=60, method='max', frac_saturated=0.07, fix=True, log=True, target=90, tolerance=60)
     cam.Snap(format='jpeg', auto=True, recalculate_each_min=None)
     if cam.GetExposureTime() > 1 and False: # we need to get a .fit and apply a dark substraction
-      time.sleep(cam.GetExposureTime()/2)
+      cam.Rest(cam.GetExposureTime()/2)
       cam.Snap(format='fit', auto=True, recalculate_each_min=None)
 
   else:
@@ -68,28 +73,27 @@ while True:
     print('Is nautical twilight = ', cam.coor.IsNauticalTwilight())
     print('Is astronomical twilight = ', cam.coor.IsAstronomicalTwilight())
 
-  outname = cam.GetFileName('jpg')
-  lastpath = '/home/astroberry/AllSky/last.jpg'
-  # copy
-  os.system('cp %s %s'%(outname, lastpath))
-
   # every 2 minutes, recalculate using max salurated pixels and take FITs
   if dt >= 120:
     if cam.verbose: print('Taking FITs... after %1.2fs!'%(cam.GetExposureTime()/2))
     prevExp = cam.GetExposure() # in sec e-6
     prevGain = cam.GetGain()
-    time.sleep(cam.GetExposureTime()/2)
+    cam.Rest(cam.GetExposureTime()/2)
     cam.SetPrefix('gain0')
     cam.Auto(forcegain=0, method='max', frac_saturated=0.04, fix=True, log=True, tolerance=50)
     cam.Snap(format='fit', auto=True, recalculate_each_min=None)
-    time.sleep(cam.GetExposureTime()/2)
+    cam.Rest(cam.GetExposureTime()/2)
     t0 = time.time()
     cam.SetExposure(prevExp)
     cam.SetGain(prevGain)
     cam.WriteLog()
 
   interval = TIME_INTERVAL_NIGHT if cam.coor.IsNight() else TIME_INTERVAL_DAY
+  timer.Add('sequencer.cycle', tcycle, time.time() - tcycle)
+  timer.WriteSnapshot(TIMING_FILE)
+  if TIMING_TRACE_FILE is not None: timer.WriteChromeTrace(TIMING_TRACE_FILE)
   if cam.verbose: print('Waiting %i seconds...'%interval)
-  time.sleep(interval)
+  with timer.Span('sequencer.sleep'):
+    time.sleep(interval)
 
 
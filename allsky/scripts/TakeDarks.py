@@ -5,27 +5,30 @@ This script automatically takes darks to create a library. We want to have:
 > Gain from 0 to 100, each 10
 > Individual darks: 10 per point
 
+The missing points at the current sensor temperature are taken first where the library is poorest (take_darks).
 '''
 
 import os
 from allsky.zwo import zwo
-from allsky.config import OUTPUT_DARKS_DIR, OUTPUT_IMAGES_DIR
+from allsky.config import OUTPUT_DARKS_DIR, OUTPUT_IMAGES_DIR, DARKS_FRAMES, DARKS_MERGE_WORKERS, DARKS_USE_MODEL
+from allsky.config import DARKS_EXPOSURES, DARKS_GAINS, DARKS_TEMP_STEP, DARKS_DISTANCE_SCALES, DARKS_MAX_DISTANCE
+from allsky.config import DARKS_REST, DARKS_REPORT_EVERY, IMGPROC_MEMORY_BUDGET
 from allsky.obscoor import obscoor
 from allsky.ServoControler import ServoControl
+from allsky.imgproc import debayer_data, debayer_tiled
+from allsky.darklib import GetDarkLibrary, GetDarkModel, GetDarkCache, GetHotPixelMaps, CombineDarks
 from astropy.io import fits
-import time, glob
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import cv2
 
 
 
-def create_master_dark(dark_files, output_file, method='median', gain=None, exposure_time=None, temperature=None):
-    darks = []
-    for dark_file in dark_files:
-        with fits.open(dark_file) as dark_fits:
-            darks.append(dark_fits[0].data)
-
-    master_dark = np.median(darks, axis=0) if method == 'median' else np.mean(darks, axis=0)
+def create_master_dark(dark_files, output_file, method='median', gain=None, exposure_time=None, temperature=None, update_index=True):
+    ''' Combine darks (median, mean or sigma-clipped mean) in tiles, with bounded memory, into a float32 master.
+        The master is written atomically, so an interrupted run never leaves half a master '''
+    master_dark = CombineDarks(dark_files, method)
     master_hdu = fits.PrimaryHDU(master_dark)
 
     if gain is not None:
@@ -34,10 +37,14 @@ def create_master_dark(dark_files, output_file, method='median', gain=None, expo
         master_hdu.header['EXPTIME'] = exposure_time
     if temperature is not None:
         master_hdu.header['TEMP'] = temperature
+    master_hdu.header['NCOMBINE'] = len(dark_files)
 
-    master_hdu.writeto(output_file, overwrite=True)
+    master_hdu.writeto(output_file + '.tmp', overwrite=True)
+    os.replace(output_file + '.tmp', output_file)
+    if update_index and gain is not None and exposure_time is not None and temperature is not None:
+        GetDarkLibrary().Add(round(temperature*10), exposure_time, gain, output_file, len(dark_files))
 
-def GetDarksPath(temp, exp, gain, idx=None):
+def GetDarksPath(temp, exp, gain, idx=None, create=True):
     temp = str(int(temp))
     exp  = str(int(exp ))
     gain = str(int(gain))
@@ -45,56 +52,155 @@ def GetDarksPath(temp, exp, gain, idx=None):
     opath = os.path.join(OUTPUT_DARKS_DIR, temp)
     opath = os.path.join(opath, exp)
     opath = os.path.join(opath, gain)
-    if not os.path.exists(opath): 
+    if create and not os.path.exists(opath): 
         os.makedirs(opath)
     if not idx is None:
         oname = "%s_%s_%s_%s.fit"%(temp, gain, exp, idx)
         opath = os.path.join(opath, oname)
     return opath
 
-def take_darks():
-  while cover.IsClose() and obs.IsAstronomicalTwilight():
-    temp = round( cam.GetTemperature() / 5 ) * 5
-
-    for exp in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]:
-        for gain in [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]:
-            for i in range(10):
-                oname = GetDarksPath(temp, exp, gain, i)
-                if os.path.exists(oname):
-                    time.sleep(0.1)
-                    continue
-                path, name = os.path.split(oname)
-                cam.SetOutPath(path)
-                cam.SetOutName(name)
-                cam.SetGain(gain)
-                cam.SetExposure(exp)
-                print('Taking dark for TEMP %i - EXP %i - GAIN %i ---> %i'%(temp, exp, gain, i))
-                cam.SnapFIT()
-                time.sleep(5)
+def dark_coverage(path=OUTPUT_DARKS_DIR, nframes=DARKS_FRAMES):
+    ''' Darks per point (temp, exp, gain) of the darks tree; the points with a master count as complete '''
+    coverage = {}
+    for temp, exp, gain, frames, master in find_dark_groups(path):
+        coverage[(temp, exp, gain)] = nframes if master is not None else len(frames)
+    return coverage
+
+def dark_priorities(coverage, temp, exposures=DARKS_EXPOSURES, gains=DARKS_GAINS, nframes=DARKS_FRAMES):
+    ''' Incomplete points of the grid at temperature temp (0.1 C), most valuable first: the ones further from any
+        complete point (the master a light would get instead), and among equally far ones those with more darks
+        already taken '''
+    cells = np.array([(temp, exp, gain) for exp in exposures for gain in gains], dtype=float)
+    done = np.array([coverage.get((temp, exp, gain), 0) for exp in exposures for gain in gains])
+    complete = np.array([k for k, n in coverage.items() if n >= nframes], dtype=float).reshape(-1, 3)
+    distance = np.full(len(cells), np.inf)
+    if len(complete):
+        # Closest temperature for each (exp, gain) of the library, then the weighted distance to those
+        scales = np.array(DARKS_DISTANCE_SCALES, dtype=float)
+        pairs, inverse = np.unique(complete[:, 1:], axis=0, return_inverse=True)
+        dtemp = np.full(len(pairs), np.inf)
+        np.minimum.at(dtemp, inverse.ravel(), np.abs(complete[:, 0] - temp))
+        distance = (dtemp[None]/scales[0] + (np.abs(cells[:, None, 1:] - pairs[None]) / scales[1:]).sum(axis=2)).min(axis=1)
+    # Sorted by distance (capped), the darks already taken only break the ties
+    order = np.lexsort((-done, -np.minimum(distance, DARKS_MAX_DISTANCE)))
+    return [(int(temp), int(cells[i, 1]), int(cells[i, 2])) for i in order if done[i] < nframes]
+
+def take_darks(max_frames=None, rest=DARKS_REST, report=DARKS_REPORT_EVERY):
+    ''' Take darks while the cover is closed and it is astronomical night, always for the most valuable missing point
+        at the current sensor temperature. Conditions are checked before every frame '''
+    coverage = dark_coverage()
+    t0 = time.time()
+    nframes, exposed, completed = 0, 0., 0
+    stop = 'max frames'
+    while max_frames is None or nframes < max_frames:
+        if not cover.IsClose():
+            stop = 'cover open'
+            break
+        if not obs.IsAstronomicalTwilight():
+            stop = 'end of the night'
+            break
+        temp = round(cam.GetTemperature() / DARKS_TEMP_STEP) * DARKS_TEMP_STEP
+        todo = dark_priorities(coverage, temp)
+        if not todo:
+            stop = 'grid complete at TEMP %i'%temp
+            break
+        key = todo[0]
+        temp, exp, gain = key
+        i = coverage.get(key, 0)
+        while os.path.exists(GetDarksPath(temp, exp, gain, i, create=False)): i += 1
+        oname = GetDarksPath(temp, exp, gain, i)
+        path, name = os.path.split(oname)
+        cam.SetOutPath(path)
+        cam.SetOutName(name)
+        cam.SetGain(gain)
+        cam.SetExposure(exp*1e6)
+        print('Taking dark for TEMP %i - EXP %i - GAIN %i ---> %i (%i points missing)'%(temp, exp, gain, i, len(todo)))
+        cam.SnapFIT(verbose=False)
+        coverage[key] = coverage.get(key, 0) + 1
+        completed += coverage[key] == DARKS_FRAMES
+        nframes += 1
+        exposed += exp
+        if report and nframes % report == 0:
+            print_dark_throughput(nframes, exposed, completed, time.time() - t0)
+        if rest: cam.Rest(rest)
+    elapsed = time.time() - t0
+    print('Stopped taking darks: %s'%stop)
+    print_dark_throughput(nframes, exposed, completed, elapsed)
+    return {'frames': nframes, 'exposed': exposed, 'completed': completed, 'elapsed': elapsed, 'stop': stop}
+
+def print_dark_throughput(nframes, exposed, completed, elapsed):
+    print('%i darks in %1.0f s (%1.1f darks/h, %1.0f%% of the time exposing), %i points completed'%(
+          nframes, elapsed, nframes/max(elapsed, 1e-9)*3600, 100*exposed/max(elapsed, 1e-9), completed))
 
 
 # Merge Darks
-def merge_darks():
-    for exp in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20]:
-        for gain in [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]:
-            for temp in range(200, 400, 5):
-                oname = GetDarksPath(temp, exp, gain, 'master')
-                opath, fname = os.path.split(oname)
-                if os.path.exists(opath):
-                    imgs = []
-                    for f in os.listdir(opath):
-                        if f.lower().endswith('.fit') or f.lower().endswith('fits'):
-                            if 'master' in f: continue
-                            imgs.append(os.path.join(opath, f))
-                    if len(imgs)==10:
-                        # Merge darks
-                        print('Merging darks for TEMP %i - EXP %i - GAIN %i'%(temp, exp, gain))
-                        create_master_dark(imgs, oname, method='median', gain=int(gain), exposure_time=float(exp), temperature=float(temp)/10)
-                        print('Created master file: ', oname)
-                        time.sleep(0.1)
-                        print('Removing individual darks for TEMP %i - EXP %i - GAIN %i'%(temp, exp, gain))
-                        for f in imgs:
-                            os.remove(f)
+def find_dark_groups(path=OUTPUT_DARKS_DIR):
+    ''' Walk the darks tree once; returns the points (temp, exp, gain) with their individual darks and master, if any '''
+    groups = []
+    for root, dirs, files in os.walk(path):
+        parts = os.path.relpath(root, path).split(os.sep)
+        if len(parts) != 3: continue
+        try:
+            temp, exp, gain = [int(x) for x in parts]
+        except ValueError:
+            continue
+        frames = sorted(os.path.join(root, f) for f in files if f.lower().endswith(('.fit', '.fits')) and 'master' not in f)
+        master = GetDarksPath(temp, exp, gain, 'master', create=False)
+        groups.append((temp, exp, gain, frames, master if os.path.exists(master) else None))
+    return groups
+
+def merge_group(temp, exp, gain, frames, leftover=False):
+    ''' Combine a group into its master and remove the individual darks (only remove them if they are leftovers
+        of a master already written by an interrupted run) '''
+    oname = GetDarksPath(temp, exp, gain, 'master', create=False)
+    if not leftover:
+        create_master_dark(frames, oname, method='median', gain=int(gain), exposure_time=float(exp), temperature=float(temp)/10, update_index=False)
+    for f in frames:
+        os.remove(f)
+    return temp, exp, gain, oname, len(frames), leftover
+
+def merge_darks(nframes=DARKS_FRAMES, workers=DARKS_MERGE_WORKERS):
+    ''' Combine all the complete groups of darks into masters, in parallel; it can be interrupted and run again.
+        Each master is added to the index as it is written (saved even if a group fails or the run is interrupted),
+        and the masters on disk missing from the index (e.g. a run that was killed) are added first '''
+    library = GetDarkLibrary()
+    todo = []
+    missing = 0
+    for temp, exp, gain, frames, master in find_dark_groups():
+        if master is not None and (temp, exp, gain) not in library.masters:
+            library.Add(temp, exp, gain, master, fits.getheader(master).get('NCOMBINE'), date=os.path.getmtime(master), save=False)
+            missing += 1
+        if not frames: continue
+        leftover = master is not None and os.path.getmtime(master) >= max(os.path.getmtime(f) for f in frames)
+        if leftover or len(frames) == nframes: todo.append((temp, exp, gain, frames, leftover))
+    if missing:
+        print('Added %i masters missing from the index'%missing)
+        library.Changed()
+        library.Save()
+    print('Merging %i groups of darks with %i processes'%(len(todo), workers))
+    if not todo: return
+    t0 = time.time()
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(merge_group, *group) for group in todo]
+            for future in as_completed(futures):
+                try:
+                    temp, exp, gain, oname, n, leftover = future.result()
+                except Exception as e:
+                    print('ERROR merging darks: %s: %s'%(type(e).__name__, e))
+                    failed += 1
+                    continue
+                if leftover:
+                    print('Removed %i leftover darks for TEMP %i - EXP %i - GAIN %i'%(n, temp, exp, gain))
+                    library.Add(temp, exp, gain, oname, fits.getheader(oname).get('NCOMBINE'), date=os.path.getmtime(oname), save=False)
+                else:
+                    print('Created master file for TEMP %i - EXP %i - GAIN %i: %s'%(temp, exp, gain, oname))
+                    library.Add(temp, exp, gain, oname, n, save=False)
+    finally:
+        library.Changed()
+        library.Save()
+    print('Merged %i groups (%i failed) in %1.1f s'%(len(todo) - failed, failed, time.time() - t0))
 
 def removeEmptyFolders(): 
     # walk though OUTPUT_DARKS_DIR subdirs and check if they are empty
@@ -107,110 +213,95 @@ def removeEmptyFolders():
 
 
 def find_closest_dark(temperature, exposure_time, gain):
-    ''' Find the closest dark to a given temperature, exposure time and gain '''
+    ''' Find the closest dark to a given temperature, exposure time and gain (from the dark library index) '''
     if temperature < 100: temperature = int(temperature*10)
-    exposure_time = int(exposure_time)
-    gain = int(gain)
-    min_temperature_diff = float('inf')
-    min_exposure_diff = float('inf')
-    min_gain_diff = float('inf')
-    closest_dark = None
-
-    ftemp = 0; fexp = 0; fgain = 0
-    for folder in glob.glob(os.path.join(OUTPUT_DARKS_DIR, '*')):
-        temp_diff = abs(int(os.path.basename(folder)) - temperature)
-        if temp_diff < min_temperature_diff:
-            min_temperature_diff = temp_diff
-            ftemp = os.path.basename(folder)
-            for exp_folder in glob.glob(os.path.join(folder, '*')):
-                exp_diff = abs(int(os.path.basename(exp_folder)) - exposure_time)
-                if exp_diff < min_exposure_diff:
-                    min_exposure_diff = exp_diff
-                    fexp = os.path.basename(exp_folder)
-                    for gain_folder in glob.glob(os.path.join(exp_folder, '*')):
-                        gain_diff = abs(int(os.path.basename(gain_folder)) - gain)
-                        if gain_diff < min_gain_diff:
-                            min_gain_diff = gain_diff
-                            fgain = os.path.basename(gain_folder)
-
-    closest_dark = os.path.join(OUTPUT_DARKS_DIR, str(ftemp), str(fexp), str(fgain), '%s_%s_%s_master.fit'%(ftemp, fgain, fexp))
-    if not os.path.exists(closest_dark):
+    closest_dark = GetDarkLibrary().Find(temperature, int(exposure_time), int(gain))
+    if closest_dark is None or not os.path.exists(closest_dark):
         print('ERROR: Something went wrong... Could not find a dark for temperature %i, exposure time %i and gain %i'%(temperature, exposure_time, gain))
         print('Closest dark: ', closest_dark, ' -- does not exist!')
         return None
         
     return closest_dark
 
-def dark_correct_img(imgpath):
-    ''' Apply dark to image '''
-    # Read the light image header
-    with fits.open(imgpath) as light_image:
-        header = light_image[0].header
-        temperature = int(header.get('CCDTEMP', 0))
-        exposure_time = int(header.get('EXPTIME', 0))
-        gain = int(header.get('GAIN', 0))
-    print('Looking for dark for TEMP %i - EXP %i - GAIN %i'%(temperature, exposure_time, gain))
+def get_dark_source(header, use_model=DARKS_USE_MODEL):
+    ''' Where the dark for a light header comes from: ('model', temp, exp, gain) with use_model (and a fitted model),
+        ('master', path) for the closest master, or None if there is none '''
+    temperature = int(header.get('CCDTEMP', 0))
+    exposure_time = int(header.get('EXPTIME', 0))
+    gain = int(header.get('GAIN', 0))
 
-    # Find the closest dark image
+    model = GetDarkModel() if use_model else None
+    if model is not None and model.coef is not None:
+        return ('model', header.get('CCDTEMP', 0), header.get('EXPTIME', 0), gain)
     closest_dark_path = find_closest_dark(temperature, exposure_time, gain)
-    print('Found closest dark: ', closest_dark_path)
-
-    # Correct the light image with the dark
+    if closest_dark_path is None: return None
+    return ('master', closest_dark_path)
+
+def get_dark_data(header, use_model=DARKS_USE_MODEL):
+    ''' Dark (float32) for a light header: the closest master (from the in-memory dark cache) or, with use_model, a
+        dark synthesized from the dark model; None if there is none '''
+    source = get_dark_source(header, use_model)
+    if source is None: return None
+    if source[0] == 'model': return GetDarkModel().Synthesize(*source[1:])
+    return GetDarkCache().Get(source[1])
+
+def get_hot_pixels(header, shape):
+    ''' Hot pixels of the closest (temperature, gain) bucket, or None if there are no maps (for this frame size) '''
+    hotpixels = GetHotPixelMaps().Get(int(header.get('CCDTEMP', 0)*10), int(header.get('GAIN', 0)))
+    if hotpixels is not None and GetHotPixelMaps().shape != shape: hotpixels = None
+    return hotpixels
+
+def dark_correct_img(imgpath, use_model=DARKS_USE_MODEL):
+    ''' Apply dark to image (see get_dark_data). The light is read once and corrected in place, as float32 '''
     with fits.open(imgpath) as light_image:
-        light_data = light_image[0].data
-
-    with fits.open(closest_dark_path) as dark_image:
-        dark_data = dark_image[0].data
+        header = light_image[0].header
+        light_data = light_image[0].data.astype(np.float32)
 
-    corrected_data = light_data - dark_data
+    dark_data = get_dark_data(header, use_model)
+    if dark_data is None: return None
+    np.subtract(light_data, dark_data, out=light_data)
 
     # Return the corrected FITS image
-    corrected_image = fits.PrimaryHDU(corrected_data, header=header)
+    corrected_image = fits.PrimaryHDU(light_data, header=header)
     return corrected_image
 
 
-def white_balance(img):
-    result = np.zeros_like(img)
-    for i in range(3):  # Iterate through R, G, and B channels
-        channel = img[:, :, i]
-        channel_median = np.median(channel)
-        scale = 32768.0 / channel_median
-        result[:, :, i] = np.clip(channel * scale, 0, 65535)
-    return result.astype(np.uint16)
-
-def remove_hot_pixels(img, kernel_size=3):
-    median_filtered = cv2.medianBlur(img, kernel_size)
-    return median_filtered
-
 def debayer(fit_image, outpath=None):
     ''' Debayer a FITS image and save it as a JPEG '''
     if isinstance(fit_image, str):
         with fits.open(fit_image) as image:
             data = image[0].data
+            header = image[0].header
         jpeg_output_path = os.path.splitext(fit_image)[0] + '.jpg'
     else:
         data = fit_image.data
+        header = fit_image.header
         jpeg_output_path = outpath if outpath is not None else 'debayered_image.jpg'
         if outpath.lower().endswith('.fit') or outpath.lower().endswith('.fits'):
             jpeg_output_path = os.path.splitext(outpath)[0] + '.jpg'
     
+    # Hot pixels; the frame is median filtered if there are no maps
+    hotpixels = get_hot_pixels(header, data.shape)
 
-    # Normalize the data to the range 0-65535 (16-bit)
-    data_normalized = ((data - data.min()) / (data.max() - data.min()) * 65535).astype(np.uint16)
-
-    # Debayer the image
-    debayered_image = cv2.cvtColor(data_normalized, cv2.COLOR_BAYER_RG2RGB)
-
-    # Apply white balance
-    balanced_image = white_balance(debayered_image)
-
-    # Remove hot pixels
-    filtered_image = remove_hot_pixels(balanced_image)
+    # Normalize, debayer, white balance, remove hot pixels and convert to 8-bit
+    debayered_image_8bit = debayer_data(data, hotpixels=hotpixels)
+    cv2.imwrite(jpeg_output_path, debayered_image_8bit)
+    print('Saved debayered image: ', jpeg_output_path)
+    return jpeg_output_path
 
-    # Convert to 8-bit and save as JPEG
-    debayered_image_8bit = (filtered_image / 256).astype(np.uint8)
+def dark_correct_debayer_tiled(imgpath, use_model=DARKS_USE_MODEL, memory=IMGPROC_MEMORY_BUDGET):
+    ''' dark_correct_img and debayer in bands of rows, with about memory bytes of working memory: the corrected
+        frame and its full-size 16-bit copies are never held. Writes the same jpeg; returns its path and whether
+        a dark was applied '''
+    with fits.open(imgpath) as light_image:
+        header = light_image[0].header
+        light_data = light_image[0].data
+    dark_data = get_dark_data(header, use_model)
+    debayered_image_8bit = debayer_tiled(light_data, dark_data, hotpixels=get_hot_pixels(header, light_data.shape), memory=memory)
+    jpeg_output_path = os.path.splitext(imgpath)[0] + '.jpg'
     cv2.imwrite(jpeg_output_path, debayered_image_8bit)
     print('Saved debayered image: ', jpeg_output_path)
+    return jpeg_output_path, dark_data is not None
 
                     
     
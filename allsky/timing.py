@@ -0,0 +1,110 @@
+'''
+ Per-stage latency instrumentation.
+ Stages are timed with spans (context manager) or with the timed decorator, and aggregated in rolling windows:
+
+   from allsky.timing import timer, timed
+   with timer.Span('sequencer.sleep'): time.sleep(30)
+
+   @timed('zwo.SnapFIT')
+   def SnapFIT(self, ...): ...
+
+   timer.WriteSnapshot('timing.json')     # count, mean, percentiles and histogram per stage
+   timer.EnableTrace()                    # also keep the last spans ...
+   timer.WriteChromeTrace('trace.json')   # ... to see them in chrome://tracing or ui.perfetto.dev
+'''
+
+import os, json, time, threading, functools
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+
+from allsky.config import TIMING_WINDOW, TIMING_TRACE_EVENTS
+
+# Histogram bins, in seconds: 1 ms to ~100 s, 4 per decade
+HISTOGRAM_EDGES = np.logspace(-3, 2, 21)
+
+class Timer:
+  def __init__(self, window=TIMING_WINDOW):
+    self.window = window
+    self.lock = threading.Lock()
+    self.stages = {} # name --> [count, total, deque of the last durations]
+    self.trace = None
+    self.pid = os.getpid()
+
+  def EnableTrace(self, maxevents=TIMING_TRACE_EVENTS):
+    ''' Keep the last maxevents spans for the chrome trace '''
+    self.trace = deque(maxlen=maxevents)
+
+  def Add(self, name, start, duration):
+    ''' Add a span: start (time.time()) and duration in seconds '''
+    with self.lock:
+      if name not in self.stages: self.stages[name] = [0, 0., deque(maxlen=self.window)]
+      stage = self.stages[name]
+      stage[0] += 1
+      stage[1] += duration
+      stage[2].append(duration)
+      if self.trace is not None:
+        self.trace.append({'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'ts': start*1e6, 'dur': duration*1e6,
+                           'pid': self.pid, 'tid': threading.get_ident()})
+
+  @contextmanager
+  def Span(self, name):
+    ''' Time a block of code '''
+    start = time.time()
+    t0 = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.Add(name, start, time.perf_counter() - t0)
+
+  def Reset(self):
+    with self.lock:
+      self.stages = {}
+      if self.trace is not None: self.trace.clear()
+
+  def Snapshot(self):
+    ''' Statistics per stage: totals since start, percentiles and histogram over the rolling window (in seconds) '''
+    with self.lock:
+      stages = {name: (count, total, np.array(durations)) for name, (count, total, durations) in self.stages.items()}
+    snapshot = {'time': time.time(), 'window': self.window, 'histogram_edges': HISTOGRAM_EDGES.tolist(), 'stages': {}}
+    for name, (count, total, durations) in sorted(stages.items()):
+      p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+      snapshot['stages'][name] = {'count': count, 'total': total, 'mean': float(durations.mean()), 'p50': float(p50), 'p90': float(p90),
+                                  'p99': float(p99), 'max': float(durations.max()), 'last': float(durations[-1]),
+                                  'histogram': np.histogram(durations, bins=HISTOGRAM_EDGES)[0].tolist()}
+    return snapshot
+
+  def WriteSnapshot(self, filename):
+    ''' Write the snapshot in a json file (atomic, so it can be read at any time) '''
+    with open(filename + '.tmp', 'w') as f:
+      json.dump(self.Snapshot(), f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+  def WriteChromeTrace(self, filename):
+    ''' Write the last spans in chrome trace format '''
+    with self.lock:
+      events = list(self.trace) if self.trace is not None else []
+    with open(filename + '.tmp', 'w') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    os.replace(filename + '.tmp', filename)
+
+  def Print(self):
+    ''' Print a table with the statistics per stage '''
+    snapshot = self.Snapshot()
+    print('%-36s %7s %10s %10s %10s %10s %10s'%('stage', 'count', 'total [s]', 'mean [s]', 'p50 [s]', 'p90 [s]', 'max [s]'))
+    for name, s in snapshot['stages'].items():
+      print('%-36s %7i %10.3f %10.4f %10.4f %10.4f %10.4f'%(name, s['count'], s['total'], s['mean'], s['p50'], s['p90'], s['max']))
+
+
+# Global timer
+timer = Timer()
+
+def timed(name):
+  ''' Decorator to time a function with the global timer '''
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with timer.Span(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
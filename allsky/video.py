@@ -0,0 +1,128 @@
+'''
+ Continuous video-mode capture.
+ A capture thread fills a ring of preallocated numpy buffers with capture_video_frame (no allocation per frame) and
+ consumers iterate over the frames:
+
+   stream = cam.StartVideo(nbuffers=4)
+   for frame in stream:
+     print(frame.seq, frame.timestamp, frame.data.mean())   # frame.data is valid until the next iteration: copy it to keep it
+   stream.Stop()
+
+ If the consumer is slower than the camera, the oldest frame waiting in the ring is dropped (and counted), so the
+ consumer always gets the most recent frames.
+'''
+
+import threading, time
+from collections import deque, namedtuple
+import numpy as np
+
+from allsky.config import ZWO_VIDEO_BUFFERS
+
+VideoFrame = namedtuple('VideoFrame', ['data', 'timestamp', 'seq'])
+
+class VideoStream:
+  def __init__(self, cam, nbuffers=ZWO_VIDEO_BUFFERS, timeout=None):
+    ''' cam is a zwo object; the image type, binning and ROI must be set before starting '''
+    if nbuffers < 2: raise ValueError('At least 2 buffers are needed')
+    self.cam = cam
+    self.camera = cam.camera
+    width, height, bins, image_type = self.camera.get_roi_format()
+    if image_type == cam.asi.ASI_IMG_RAW16:
+      dtype, shape = np.uint16, (height, width)
+    elif image_type == cam.asi.ASI_IMG_RGB24:
+      dtype, shape = np.uint8, (height, width, 3)
+    else:
+      dtype, shape = np.uint8, (height, width)
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    self.buffers = [bytearray(nbytes) for i in range(nbuffers)]
+    self.arrays = [np.frombuffer(b, dtype=dtype).reshape(shape) for b in self.buffers]
+    self.timeout = timeout if timeout is not None else int(cam.GetExposure()/1000*2 + 500)
+
+    self.cond = threading.Condition()
+    self.free = deque(range(nbuffers))
+    self.ready = deque() # (buffer index, timestamp, seq)
+    self.held = None     # buffer lent to the consumer
+    self.running = False
+    self.thread = None
+    self.captured = 0
+    self.delivered = 0
+    self.dropped = 0
+    self.errors = 0
+    self.t0 = None
+
+  def Start(self):
+    ''' Start video mode and the capture thread '''
+    self.cam.PrepareVideo()
+    self.camera.start_video_capture()
+    self.running = True
+    self.t0 = time.time()
+    self.thread = threading.Thread(target=self.Capture, name='VideoStream', daemon=True)
+    self.thread.start()
+    return self
+
+  def Stop(self):
+    ''' Stop the capture thread and video mode '''
+    self.running = False
+    with self.cond: self.cond.notify_all()
+    if self.thread is not None: self.thread.join()
+    self.thread = None
+    self.camera.stop_video_capture()
+
+  def Capture(self):
+    ''' Capture loop (capture thread) '''
+    while self.running:
+      with self.cond:
+        if self.free:
+          idx = self.free.popleft()
+        else:
+          # Ring full: drop the oldest frame that the consumer did not take
+          idx = self.ready.popleft()[0]
+          self.dropped += 1
+      try:
+        self.camera.get_video_data(timeout=self.timeout, buffer_=self.buffers[idx])
+      except Exception as e:
+        with self.cond:
+          self.free.appendleft(idx)
+          self.errors += 1
+        if self.running and self.cam.verbose: print('ERROR capturing video frame: %s'%e)
+        continue
+      with self.cond:
+        self.ready.append((idx, time.time(), self.captured))
+        self.captured += 1
+        self.cond.notify()
+
+  def GetFrame(self, timeout=None):
+    ''' Get the next frame (or None after timeout seconds or if stopped); the previous frame is released '''
+    with self.cond:
+      if self.held is not None:
+        self.free.append(self.held)
+        self.held = None
+      if not self.cond.wait_for(lambda: self.ready or not self.running, timeout):
+        return None
+      if not self.ready: return None
+      idx, timestamp, seq = self.ready.popleft()
+      self.held = idx
+      self.delivered += 1
+    return VideoFrame(self.arrays[idx], timestamp, seq)
+
+  def __iter__(self):
+    while self.running or self.ready:
+      frame = self.GetFrame(timeout=self.timeout/1000.)
+      if frame is None:
+        if not self.running: return
+        continue
+      yield frame
+
+  def __enter__(self):
+    return self.Start() if not self.running else self
+
+  def __exit__(self, *args):
+    self.Stop()
+
+  def GetStats(self):
+    ''' Frame counts and rates '''
+    with self.cond:
+      elapsed = time.time() - self.t0 if self.t0 is not None else 0
+      return {'captured': self.captured, 'delivered': self.delivered, 'dropped': self.dropped, 'errors': self.errors,
+              'sdk_dropped': self.camera.get_dropped_frames(), 'elapsed': elapsed,
+              'fps': self.captured/elapsed if elapsed > 0 else 0.}
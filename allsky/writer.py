@@ -0,0 +1,75 @@
+'''
+ Background writer: the capture loop only hands the frames (and what to do with them) to a bounded queue,
+ and worker threads do the encoding, FITs serialization and file publication.
+ When the queue is full (slow media), Submit blocks until there is room: the capture loop slows down instead of
+ piling up frames in memory.
+
+   writer = ImageWriter()
+   writer.Submit(cam.WriteFIT, img, header, filename)
+   writer.Flush()
+'''
+
+import queue, threading, time, atexit
+
+from allsky.config import WRITER_WORKERS, WRITER_QUEUE_SIZE
+from allsky.timing import timer
+
+class ImageWriter:
+  def __init__(self, nworkers=WRITER_WORKERS, maxsize=WRITER_QUEUE_SIZE, verbose=1):
+    self.verbose = verbose
+    self.queue = queue.Queue(maxsize)
+    self.lock = threading.Lock()
+    self.submitted = 0
+    self.done = 0
+    self.errors = 0
+    self.waited = 0. # time the capture loop was blocked because the queue was full
+    self.workers = [threading.Thread(target=self.Work, name='ImageWriter-%i'%i, daemon=True) for i in range(nworkers)]
+    for w in self.workers: w.start()
+    atexit.register(self.Close)
+
+  def Submit(self, func, *args, **kwargs):
+    ''' Queue a job; blocks while the queue is full '''
+    t0 = time.time()
+    self.queue.put((func, args, kwargs))
+    dt = time.time() - t0
+    timer.Add('writer.wait', t0, dt)
+    with self.lock:
+      self.submitted += 1
+      self.waited += dt
+    if self.verbose >= 2 and dt > 0.1: print('Writer queue full: waited %1.2f s'%dt)
+
+  def Work(self):
+    ''' Worker loop '''
+    while True:
+      job = self.queue.get()
+      if job is None:
+        self.queue.task_done()
+        return
+      func, args, kwargs = job
+      try:
+        with timer.Span('writer.job'):
+          func(*args, **kwargs)
+        with self.lock: self.done += 1
+      except Exception as e:
+        with self.lock: self.errors += 1
+        print('ERROR in background writer (%s): %s'%(getattr(func, '__name__', func), e))
+      finally:
+        self.queue.task_done()
+
+  def Pending(self):
+    ''' Number of jobs in the queue '''
+    return self.queue.qsize()
+
+  def Flush(self):
+    ''' Wait until all the queued jobs are done '''
+    self.queue.join()
+
+  def Close(self):
+    ''' Finish the queued jobs and stop the workers '''
+    if not any(w.is_alive() for w in self.workers): return
+    for w in self.workers: self.queue.put(None)
+    for w in self.workers: w.join()
+
+  def GetStats(self):
+    with self.lock:
+      return {'submitted': self.submitted, 'done': self.done, 'errors': self.errors, 'pending': self.Pending(), 'waited': self.waited}
@@ -1,20 +1,50 @@
 #!/usr/bin/env python
 
 import argparse
-import os, sys, time, json
-import zwoasi as asi
-from astropy.io import fits
-import cv2
+import os, sys, time, json, shutil, tempfile, threading
+from contextlib import contextmanager
 import numpy as np
 
 from allsky.obscoor import obscoor
-from allsky.config import SDK_LIB_PATH, OUTPUT_IMAGES_DIR, ZWO_LOG, ZWO_EXPMAX
+from allsky.writer import ImageWriter
+from allsky.video import VideoStream
+from allsky.timing import timer, timed
+from allsky.exposure import GetHistogram, GetSaturatedFraction, HistogramValue, PredictExposure
+from allsky.config import SDK_LIB_PATH, OUTPUT_IMAGES_DIR, ZWO_LOG, ZWO_EXPMAX, ZWO_METER_STEP, ZWO_METER_RADIUS, ZWO_METER_BINS, ZWO_METER_ROI, ZWO_AUTOEXP_SOLVER, ZWO_BACKEND, ZWO_TEMP_REFRESH, ZWO_VIDEO_BUFFERS
+
+
+def GetBackend(name=ZWO_BACKEND):
+  ''' Camera backend: 'asi' (zwoasi, the real camera) or 'sim' (allsky.zwosim, a simulated camera) '''
+  if name.lower().startswith('sim'):
+    import allsky.zwosim as backend
+  else:
+    import zwoasi as backend
+  return backend
+
+
+class SDKCounter:
+  ''' Wraps the camera and counts the calls to each SDK method '''
+  def __init__(self, camera):
+    self.__dict__['_camera'] = camera
+    self.__dict__['calls'] = {}
+
+  def __getattr__(self, name):
+    attr = getattr(self._camera, name)
+    if not callable(attr): return attr
+    def call(*args, **kwargs):
+      self.calls[name] = self.calls.get(name, 0) + 1
+      return attr(*args, **kwargs)
+    return call
+
+  def __setattr__(self, name, value):
+    setattr(self._camera, name, value)
 
 
 class zwo:
 
-  def __init__(self, verbose=1):
+  def __init__(self, verbose=1, backend=ZWO_BACKEND):
     # Init
+    self.asi = asi = GetBackend(backend)
     asi.init(SDK_LIB_PATH)
 
     # Look for a camera and connect
@@ -25,15 +55,28 @@ class zwo:
       exit()
     if self.verbose: print("Using: %s"%cameras_found[0])
 
-    self.camera = asi.Camera(0)
+    self.camera = SDKCounter(asi.Camera(0))
     self.name = cameras_found[0]
     self.camera_info = self.camera.get_camera_property()
     self.controls = self.camera.get_controls()
+    self.control_names = {self.controls[c]['ControlType']: c for c in self.controls}
+    self.control_values = {} # values set by this process, by control type
+    self.image_type = None
+    self.temperature = None
+    self.temperature_time = 0
     self.SetDefaultValues()
     self.filename = 'temp'
     self.outpath = './'
     self.prefix = None
     self.sufix = None
+    self.skymask = None
+    self.meterstep = ZWO_METER_STEP
+    self.metering = False
+    self.writer = None
+    self.publishpath = None
+    self.publishlock = threading.Lock()
+    self.frame = 0 # sequence number of the last frame captured for the publish path
+    self.published = 0 # ... and of the last one published
     self.coor = obscoor()
     self.SetOutPath(OUTPUT_IMAGES_DIR)
 
@@ -46,15 +89,19 @@ class zwo:
     ''' Craft fits header '''
     # Temperature, exposure time, gain
     # type (dark, light), date, humidity, site coordinates
-    settings = self.camera.get_control_values()
     headerdic = {}
-    headerdic['GAIN']= settings['Gain']
-    headerdic['EXPTIME'] = float(settings['Exposure'])/1e6
-    headerdic['CCDTEMP'] = float(settings['Temperature'])/10 
+    headerdic['GAIN']= self.GetGain()
+    headerdic['EXPTIME'] = float(self.GetExposure())/1e6
+    headerdic['CCDTEMP'] = float(self.GetTemperature())/10 
     headerdic['AUTHOR'] = "CERECEDA OBS" 
     headerdic['INSTRUME'] = self.name 
     headerdic['TELESCOP'] = "ALLSKY"
     headerdic['DATE'] = self.coor.GetTimeNow()
+    moonalt, moonaz = self.coor.GetMoonAltAz()
+    headerdic['MOONPHAS'] = round(self.coor.GetMoonPhase(), 2)
+    headerdic['MOONALT'] = round(moonalt, 2)
+    headerdic['MOONAZ'] = round(moonaz, 2)
+    headerdic['PLANETS'] = ','.join(self.coor.GetVisiblePlanets())
     return headerdic
 
   def WriteLog(self):
@@ -93,38 +140,62 @@ class zwo:
     ''' Set out path '''
     self.outpath = name
 
+  def SetControl(self, control_type, value):
+    ''' Set a control value, only if it changes '''
+    value = int(value)
+    if self.control_values.get(control_type) == value: return
+    self.camera.set_control_value(control_type, value)
+    self.control_values[control_type] = value
+
+  def SetImageType(self, image_type):
+    ''' Set the image type, only if it changes '''
+    if self.image_type == image_type: return
+    self.camera.set_image_type(image_type)
+    self.image_type = image_type
+
   def SetExposure(self, exposure):
     ''' Set exposure '''
     if self.verbose >= 2: print('Setting exposure to %i'%int(exposure))
-    self.camera.set_control_value(asi.ASI_EXPOSURE, exposure)
+    self.SetControl(self.asi.ASI_EXPOSURE, exposure)
 
   def SetGain(self, gain):
     ''' Set gain '''
     if self.verbose >= 2: print('Setting gain to %i'%(int(gain)))
-    self.camera.set_control_value(asi.ASI_GAIN, gain)
+    self.SetControl(self.asi.ASI_GAIN, gain)
 
   def SetDefaultValues(self):
     ''' Set to MY default values '''
     #self.camera.set_control_value(asi.ASI_BANDWIDTHOVERLOAD, camera.get_controls()['BandWidth']['MinValue']) # Use minimum USB bandwidth permitted
     #self.camera.disable_dark_subtract()
-    self.camera.set_control_value(asi.ASI_GAIN, 10)
-    self.camera.set_control_value(asi.ASI_EXPOSURE, 1000000)
-    self.camera.set_control_value(asi.ASI_WB_B, 99)
-    self.camera.set_control_value(asi.ASI_WB_R, 75)
-    self.camera.set_control_value(asi.ASI_GAMMA, 50)
-    self.camera.set_control_value(asi.ASI_BRIGHTNESS, 50)
-    self.camera.set_control_value(asi.ASI_FLIP, 0)
+    self.SetControl(self.asi.ASI_GAIN, 10)
+    self.SetControl(self.asi.ASI_EXPOSURE, 1000000)
+    self.SetControl(self.asi.ASI_WB_B, 99)
+    self.SetControl(self.asi.ASI_WB_R, 75)
+    self.SetControl(self.asi.ASI_GAMMA, 50)
+    self.SetControl(self.asi.ASI_BRIGHTNESS, 50)
+    self.SetControl(self.asi.ASI_FLIP, 0)
 
   def RestoreDefaultControls(self):
     ''' Restore all controls to zwo-default values except USB bandwidth '''
     for c in self.controls:
-      if self.controls[c]['ControlType'] == asi.ASI_BANDWIDTHOVERLOAD:
+      if self.controls[c]['ControlType'] == self.asi.ASI_BANDWIDTHOVERLOAD:
+        continue
+      if not self.controls[c]['IsWritable']:
         continue
-      self.camera.set_control_value(self.controls[c]['ControlType'], self.controls[c]['DefaultValue'])
+      self.SetControl(self.controls[c]['ControlType'], self.controls[c]['DefaultValue'])
+
+  def SetPublishPath(self, path):
+    ''' Copy each new jpeg to this path (e.g. last.jpg for the web) -- None to disable '''
+    self.publishpath = path
+
+  def EnableBackgroundWriter(self, nworkers=None, maxsize=None):
+    ''' Encode and write the images in background threads, so the camera does not wait for the media '''
+    kwargs = {k: v for k, v in [('nworkers', nworkers), ('maxsize', maxsize)] if v is not None}
+    self.writer = ImageWriter(verbose=self.verbose, **kwargs)
 
   def SetTimeOut(self):
     ''' Set the timeout '''
-    timeout = (self.camera.get_control_value(asi.ASI_EXPOSURE)[0] / 1000) * 2 + 500
+    timeout = (self.GetExposure() / 1000) * 2 + 500
     self.camera.default_timeout = timeout
 
 
@@ -142,9 +213,25 @@ class zwo:
     sufix = self.coor.GetTimeNow("%Y_%m_%d_%H_%M_%S")
     self.SetSufix(sufix)
 
-  def GetTemperature(self):
-    settings = self.camera.get_control_values()
-    return settings['Temperature']
+  def GetControl(self, control_type):
+    ''' Get a control value: from the values set by this process or, if never set, from the camera '''
+    if control_type not in self.control_values:
+      self.control_values[control_type] = self.camera.get_control_value(control_type)[0]
+    return self.control_values[control_type]
+
+  def GetTemperature(self, refresh=ZWO_TEMP_REFRESH):
+    ''' Get the sensor temperature (in 0.1 C); it is read from the camera at most once every [refresh] seconds '''
+    if self.temperature is None or time.time() - self.temperature_time >= refresh:
+      self.temperature = self.camera.get_control_value(self.asi.ASI_TEMPERATURE)[0]
+      self.temperature_time = time.time()
+    return self.temperature
+
+  def GetSDKCalls(self):
+    ''' Number of calls to each SDK method '''
+    return dict(self.camera.calls)
+
+  def ResetSDKCalls(self):
+    self.camera.calls.clear()
 
   def GetOutName(self):
     ''' Craft the name of the output file, considering the prefix and sufix, if any '''
@@ -174,15 +261,15 @@ class zwo:
 
   def GetExposure(self):
     ''' Get exposure '''
-    return self.camera.get_control_value(asi.ASI_EXPOSURE)[0]
+    return self.GetControl(self.asi.ASI_EXPOSURE)
 
   def GetExposureTime(self):
     ''' Get exposure time in seconds '''
-    return self.camera.get_control_value(asi.ASI_EXPOSURE)[0]/1e6
+    return self.GetControl(self.asi.ASI_EXPOSURE)/1e6
   
   def GetGain(self):
     ''' Get gain '''
-    return self.camera.get_control_value(asi.ASI_GAIN)[0]
+    return self.GetControl(self.asi.ASI_GAIN)
 
   #######################################################################################################################
   ### Prints and verbosity
@@ -219,38 +306,129 @@ class zwo:
     except:
       pass
 
+  @timed('zwo.SnapTIFF')
   def SnapTIFF(self, outname=None, verbose=None):
     ''' Save a monocolor 16-bit tiff image '''
     if verbose is None: verbose = self.verbose
-    if verbose: print('Capturing a single 16-bit mono with exp = %gs and gain = %1.0f'%(self.camera.get_control_value(asi.ASI_EXPOSURE)[0]/1e6, self.camera.get_control_value(asi.ASI_GAIN)[0]))
+    if verbose: print('Capturing a single 16-bit mono with exp = %gs and gain = %1.0f'%(self.GetExposureTime(), self.GetGain()))
     filename = self.GetFileName('tiff')
-    self.camera.set_image_type(asi.ASI_IMG_RAW16)
-    self.camera.capture(filename=filename)
+    self.SetImageType(self.asi.ASI_IMG_RAW16)
+    with timer.Span('zwo.capture'):
+      self.camera.capture(filename=filename)
     if verbose: print('Saved to %s' % filename)
 
+  @timed('zwo.SnapJPEG')
   def SnapJPEG(self, outname=None, verbose=None):
     ''' Save color jpeg image '''
     filename = self.GetFileName('jpg', outname)
-    self.camera.set_image_type(asi.ASI_IMG_RGB24)
+    self.SetImageType(self.asi.ASI_IMG_RGB24)
     if verbose is None: verbose = self.verbose
-    if verbose: print('Capturing a single, color image with exp = %gs and gain = %1.0f'%(self.camera.get_control_value(asi.ASI_EXPOSURE)[0]/1e6, self.camera.get_control_value(asi.ASI_GAIN)[0]))
-    self.camera.capture(filename=filename)
-    if verbose: print('Saved to %s' % filename)
+    if verbose: print('Capturing a single, color image with exp = %gs and gain = %1.0f'%(self.GetExposureTime(), self.GetGain()))
+    if self.writer is None:
+      with timer.Span('zwo.capture'):
+        self.camera.capture(filename=filename)
+      self.Publish(filename)
+    else:
+      with timer.Span('zwo.capture'):
+        img = self.camera.capture()
+      self.Write(self.WriteJPEG, img, filename, self.NextFrame())
+    if verbose: self.PrintSaved(filename)
 
+  @timed('zwo.SnapFIT')
   def SnapFIT(self, outname=None, verbose=None):
     ''' Save a FITs file '''
-    self.camera.set_image_type(asi.ASI_IMG_RAW16)
+    self.SetImageType(self.asi.ASI_IMG_RAW16)
     if verbose is None: verbose = self.verbose
-    if verbose: print('Capturing a single 16-bit FITS with exp = %gs and gain = %1.0f'%(self.camera.get_control_value(asi.ASI_EXPOSURE)[0]/1e6, self.camera.get_control_value(asi.ASI_GAIN)[0]))
+    if verbose: print('Capturing a single 16-bit FITS with exp = %gs and gain = %1.0f'%(self.GetExposureTime(), self.GetGain()))
     img = self.GetRawImage()
-    hdu = fits.PrimaryHDU(img)
     filename = self.GetFileName('fit', outname)
-    header = self.CraftFitsHeader()
+    self.Write(self.WriteFIT, img, self.CraftFitsHeader(), filename)
+    if verbose: self.PrintSaved(filename)
+
+  @timed('zwo.SnapFITandJPEG')
+  def SnapFITandJPEG(self, outname=None, verbose=None):
+    ''' Save a FITs file and a color jpeg image, both from the same 16-bit exposure '''
+    self.SetImageType(self.asi.ASI_IMG_RAW16)
+    if verbose is None: verbose = self.verbose
+    if verbose: print('Capturing a single 16-bit FITS + jpeg with exp = %gs and gain = %1.0f'%(self.GetExposureTime(), self.GetGain()))
+    img = self.GetRawImage()
+    frame = self.NextFrame()
+    filename = self.GetFileName('fit', outname)
+    self.Write(self.WriteFIT, img, self.CraftFitsHeader(), filename)
+    if verbose: self.PrintSaved(filename)
+    filename = self.GetFileName('jpg', outname)
+    self.Write(self.WriteDebayeredJPEG, img, filename, frame)
+    if verbose: self.PrintSaved(filename)
+
+  #######################################################################################################################
+  ### Write -- in the background writer if enabled
+  #######################################################################################################################
+
+  def Write(self, func, *args):
+    ''' Run a write job: queued in the background writer if enabled, now otherwise '''
+    if self.writer is not None:
+      self.writer.Submit(func, *args)
+    else:
+      func(*args)
+
+  def PrintSaved(self, filename):
+    if self.writer is None: print('Saved to %s' % filename)
+    else: print('Queued to %s (%i pending)' % (filename, self.writer.Pending()))
+
+  @timed('write.FIT')
+  def WriteFIT(self, img, header, filename):
+    ''' Write a numpy image and a header (dictionary) in a FITs file '''
+    from astropy.io import fits
+    hdu = fits.PrimaryHDU(img)
     for k in header: hdu.header[k] = header[k]
     if os.path.isfile(filename): os.system('mv %s %s.old'%(filename, filename))
     hdu.writeto(filename)
-    if verbose: print('Saved to %s' % filename)
 
+  @timed('write.JPEG')
+  def WriteJPEG(self, img, filename, frame=None):
+    ''' Write an 8-bit BGR numpy image in a jpeg file and publish it (frame: see Publish) '''
+    import cv2
+    cv2.imwrite(filename, img)
+    self.Publish(filename, frame)
+
+  def WriteDebayeredJPEG(self, img, filename, frame=None):
+    ''' Debayer a 16-bit image and write it in a jpeg file '''
+    from allsky.imgproc import debayer_data
+    with timer.Span('write.debayer'):
+      img = debayer_data(img, self.camera_info['BayerPattern'])
+    self.WriteJPEG(img, filename, frame)
+
+  def NextFrame(self):
+    ''' Sequence number of a new frame, taken at capture time so the writer threads can publish out of order '''
+    with self.publishlock:
+      self.frame += 1
+      return self.frame
+
+  @timed('write.Publish')
+  def Publish(self, filename, frame=None):
+    ''' Copy a jpeg to the publish path, if any (atomic, so readers never get half a file). frame is its sequence
+        number (NextFrame, a new one if None): a frame older than the last one published is skipped '''
+    if self.publishpath is None: return
+    if frame is None: frame = self.NextFrame()
+    with self.publishlock:
+      if frame < self.published: return
+      fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.publishpath)), suffix='.tmp')
+      try:
+        os.close(fd)
+        shutil.copyfile(filename, temp)
+        os.chmod(temp, 0o644) # mkstemp makes it private, the web server must read it
+        os.replace(temp, self.publishpath)
+      except BaseException:
+        if os.path.exists(temp): os.remove(temp)
+        raise
+      self.published = frame
+
+  def Rest(self, seconds):
+    ''' Wait a bit so the camera rests... this avoid some errors from the camera '''
+    with timer.Span('zwo.rest'):
+      time.sleep(seconds)
+
+  @timed('zwo.Snap')
   def Snap(self, format='jpg', auto=True, recalculate_each_min=10, outname=None, verbose=None):
     ''' Snap a single image '''
     if recalculate_each_min is not None and recalculate_each_min >= 0:
@@ -270,6 +448,8 @@ class zwo:
       self.SnapJPEG(outname=outname)
     elif format.lower() == 'fit' or format.lower() == 'fits':
       self.SnapFIT(outname=outname)
+    elif format.lower() in ['fit+jpg', 'fit+jpeg', 'fits+jpg', 'fits+jpeg']:
+      self.SnapFITandJPEG(outname=outname)
     self.WriteLog()
     #if self.verbose >= 1:
     #  self.PrintControlValues()
@@ -280,13 +460,52 @@ class zwo:
     self.camera.start_video_capture()
     self.sufix = 'video'
     filename = self.GetFileName('jpg')
-    self.camera.set_image_type(asi.ASI_IMG_RGB24)
+    self.SetImageType(self.asi.ASI_IMG_RGB24)
     self.camera.capture_video_frame(filename=filename)
+    self.camera.stop_video_capture()
     if self.verbose: print('Saved to %s' % filename)
 
+  def StartVideo(self, nbuffers=ZWO_VIDEO_BUFFERS, image_type=None):
+    ''' Start continuous video capture; returns a VideoStream to iterate over the frames (see allsky.video) '''
+    self.SetImageType(self.asi.ASI_IMG_RGB24 if image_type is None else image_type)
+    if self.verbose: print('Starting video stream with %i buffers'%nbuffers)
+    return VideoStream(self, nbuffers=nbuffers).Start()
+
   def GetRawImage(self):
     ''' Get a numpy image '''
-    return self.camera.capture()
+    with timer.Span('zwo.capture'):
+      return self.camera.capture()
+
+  @contextmanager
+  def MeteringFormat(self, bins=ZWO_METER_BINS, roi=ZWO_METER_ROI):
+    ''' Switch to a binned RGB24 format (cropped to the square around the sky circle if roi) for the metering frames, and restore the previous format on exit '''
+    if self.metering or (bins == 1 and not roi):
+      yield
+      return
+    start_x, start_y, width, height = self.camera.get_roi()
+    prevbins, prevtype = self.camera.get_roi_format()[2:]
+    size = None
+    if roi:
+      size = int(min(self.camera_info['MaxWidth'], self.camera_info['MaxHeight']) / bins)
+      size -= size % 8
+    self.camera.set_roi(width=size, height=size, bins=bins, image_type=self.asi.ASI_IMG_RGB24)
+    self.image_type = self.asi.ASI_IMG_RGB24
+    # Keep about the same number of metering pixels
+    self.meterstep = max(1, ZWO_METER_STEP // bins)
+    self.metering = True
+    try:
+      yield
+    finally:
+      self.camera.set_roi(start_x, start_y, width, height, prevbins, prevtype)
+      self.image_type = prevtype
+      self.meterstep = ZWO_METER_STEP
+      self.metering = False
+
+  def GetMeteringImage(self):
+    ''' Get a color 8-bit numpy image for metering -- nothing is written to disk '''
+    self.SetImageType(self.asi.ASI_IMG_RGB24)
+    with timer.Span('zwo.capture.metering'):
+      return self.camera.capture()
 
   def SaveControlValues(self):
     ''' Save the control values in a txt file '''
@@ -303,6 +522,35 @@ class zwo:
   ### Auto exposure
   #######################################################################################################################
 
+  def GetSkyMask(self, shape):
+    ''' Masks of the sky circle and of the corners out of the image circle for a (decimated) frame of a given shape -- cached '''
+    shape = tuple(shape[:2])
+    if self.skymask is None or self.skymask[0].shape != shape:
+      h, w = shape
+      yy, xx = np.ogrid[:h, :w]
+      r2 = (yy - (h-1)/2.)**2 + (xx - (w-1)/2.)**2
+      r = min(h, w) / 2.
+      self.skymask = (r2 <= (ZWO_METER_RADIUS*r)**2, r2 > r*r)
+    return self.skymask
+
+  def GetSkyPixels(self, image):
+    ''' Get the pixels in a decimated sky region of the image '''
+    sub = image[::self.meterstep, ::self.meterstep]
+    return sub[self.GetSkyMask(sub.shape)[0]]
+
+  def GetBlackLevel(self, image):
+    ''' Get the black level from the corners out of the image circle (None if there are no corners) '''
+    sub = image[::self.meterstep, ::self.meterstep]
+    corners = sub[self.GetSkyMask(sub.shape)[1]]
+    return float(np.median(corners)) if corners.size else None
+
+  def MeterImage(self, image, method='average'):
+    ''' Get the mean (or median) value and the fraction of saturated values in a decimated sky region of the image '''
+    sky = self.GetSkyPixels(image)
+    value = np.median(sky) if method.lower() == 'median' else np.mean(sky)
+    frac = np.count_nonzero(sky == 255) / sky.size
+    return value, frac
+
   def GetAutoGain(self):
     ''' Get gain based on day status '''
     if not self.coor.IsNight():
@@ -332,7 +580,8 @@ class zwo:
       self.SetExposure(exp)
     return gain, exp
 
-  def AutoExposure(self, initial_exposure=None, tolerance=20, target=150, max_iterations=10, gain=None, frac_saturated=None, method='average'):
+  @timed('zwo.AutoExposure')
+  def AutoExposure(self, initial_exposure=None, tolerance=20, target=150, max_iterations=10, gain=None, frac_saturated=None, method='average', solver=ZWO_AUTOEXP_SOLVER, max_gain=None):
     ''' Get autoexposure by hand 
         Method: average
           Take average pixel value and take it to [target] with a tolerance of [tolerance], ignore saturated pixels
@@ -340,6 +589,11 @@ class zwo:
           Take median pixel value and take it to [target] with a tolerance of [tolerance], ignore saturated pixels
         Method: max
           Take the number of saturated pixels to be less than [frac_saturated] *or* median to target with some tolerance
+        Solver: ratio
+          Scale the exposure by target/value on each iteration
+        Solver: histogram
+          Predict the exposure from the histogram of the frame (see allsky.exposure); usually converges in one or two frames.
+          If max_gain is given, the gain can be raised up to max_gain when the maximum exposure is not enough.
     '''
     if gain is None: 
       gain = self.GetAutoGain()
@@ -349,29 +603,24 @@ class zwo:
       _, initial_exposure = self.SettingFromLog(set=False)
       
     self.SetGain(gain)
-    exposure = initial_exposure
-    iteration = -1
+    with self.MeteringFormat():
+      if solver == 'histogram':
+        return self.AutoExposureHistogram(initial_exposure, gain, target=target, tolerance=tolerance, max_iterations=max_iterations, frac_saturated=frac_saturated, method=method, max_gain=max_gain)
+      return self.AutoExposureRatio(initial_exposure, gain, target=target, tolerance=tolerance, max_iterations=max_iterations, frac_saturated=frac_saturated, method=method)
 
-    ofname = self.GetFileName('jpg', 'for_auto_exp')
+  def AutoExposureRatio(self, exposure, gain, target=150, tolerance=20, max_iterations=10, frac_saturated=None, method='average'):
+    ''' Auto exposure scaling the exposure by target/value on each frame '''
+    iteration = -1
     reachedMValue = False
 
     while iteration < max_iterations:
         # Take a picture with the current gain and exposure settings
         iteration += 1
         self.SetExposure(exposure)
-        self.SnapJPEG(outname='for_auto_exp', verbose=False)
-
-        # Read the output image and calculate the mean pixel value
-        image = cv2.imread(ofname)
 
-        if method == 'average' or method == 'max':
-          value = np.mean(image)
-        elif method == 'median':
-          value = np.median(image)
-
-        n_satruated = np.sum(image == 255)
-        n_total = np.sum(np.ones(image.shape))
-        frac = n_satruated / n_total
+        # Meter the frame in memory: mean (or median) pixel value and fraction of saturated pixels
+        image = self.GetMeteringImage()
+        value, frac = self.MeterImage(image, method)
 
         # Check if the mean pixel value is within the tolerance range of the target mean
         if float(target - tolerance) <= value <= float(target + tolerance) or reachedMValue:
@@ -395,7 +644,7 @@ class zwo:
         exposure = int(exposure * ratio)
 
         # Wait a bit so the camera rests... this avoid some errors from the camera
-        time.sleep(exposure/1e6/2)
+        self.Rest(exposure/1e6/2)
 
         if exposure > ZWO_EXPMAX*1e6:
           print('Setting exposure to max: ', ZWO_EXPMAX, 's')
@@ -407,6 +656,39 @@ class zwo:
     self.SetExposure(exposure)
     return exposure
 
+  def AutoExposureHistogram(self, exposure, gain, target=150, tolerance=20, max_iterations=10, frac_saturated=None, method='average', max_gain=None):
+    ''' Auto exposure with the predictive histogram solver '''
+    if method != 'max': frac_saturated = None
+    for iteration in range(max_iterations+1):
+      self.SetExposure(exposure)
+      image = self.GetMeteringImage()
+      hist = GetHistogram(self.GetSkyPixels(image))
+      value = HistogramValue(hist, 'median' if method == 'median' else 'average')
+      frac = GetSaturatedFraction(hist)
+      newexp, newgain, predicted = PredictExposure(hist, exposure, gain, target=target, method=method, black=self.GetBlackLevel(image), frac_saturated=frac_saturated, max_gain=max_gain)
+
+      # Converged: within tolerance or, if the saturation limits the exposure, nothing left to gain
+      saturation_ok = frac_saturated is None or frac <= frac_saturated
+      if saturation_ok and (float(target - tolerance) <= value <= float(target + tolerance) or (value < target and newgain == gain and abs(newexp/exposure - 1) < 0.05)):
+        if self.verbose:
+          print(f"Auto exposure successful after {iteration+1} frames. Gain: {gain}, Exposure: {exposure}, Frac of saturated pexels: {frac*100:.2f}%")
+        return exposure
+
+      if self.verbose >= 2:
+        print('value = ', value, ', saturated = ', frac*100, '%, target = ', target, ', exposure = ', exposure, ' --> ', newexp, ', gain = ', gain, ' --> ', newgain, ', predicted = ', predicted)
+      if newexp == exposure and newgain == gain:
+        print('Auto exposure reached the limits: exposure = %1.6f s, gain = %i'%(exposure/1e6, gain))
+        return exposure
+      exposure = newexp
+      if newgain != gain:
+        gain = newgain
+        self.SetGain(gain)
+
+    print("Auto exposure failed to converge. Using the last prediction.")
+    self.SetExposure(exposure)
+    return exposure
+
+  @timed('zwo.Auto')
   def Auto(self, forcegain=None, target=150, tolerance=20, frac_saturated=0.07, method='average', fix=True, log=True, startFrom='log', verbose=1):
     ''' Check if auto exposure and auto gain is giving good results -- if not, set it automatically '''
     if startFrom.lower().startswith('log'):
@@ -417,35 +699,32 @@ class zwo:
       gain, exposure = self.GetAutoFromCurrentTime(set=False)
     if forcegain is not None:
       gain = forcegain
-    self.SetGain(gain)
-    self.SetExposure(exposure)
-    self.SnapJPEG(outname='for_auto_exp')
-    ofname = self.GetFileName('jpg', 'for_auto_exp')
-    image = cv2.imread(ofname)
-    value = np.mean(image) if method.lower() != 'median' else np.median(image)
-    if method.lower() == 'max':
-      n_satruated = np.sum(image == 255)
-      n_total = image.shape[0] * image.shape[1]
-      frac = n_satruated / n_total
-      if frac > frac_saturated:
-        print(f'Check failed: {frac*100:.2f}% of the pixels are saturated')
+    with self.MeteringFormat():
+      self.SetGain(gain)
+      self.SetExposure(exposure)
+      image = self.GetMeteringImage()
+      value, frac = self.MeterImage(image, method)
+      if self.verbose >= 2: print(f'Metering: value = {value:.2f}, saturated = {frac*100:.2f}%')
+      if method.lower() == 'max':
+        if frac > frac_saturated:
+          print(f'Check failed: {frac*100:.2f}% of the pixels are saturated')
+          if fix:
+            print('Running auto exposure... (after waiting %1.2f s)'%(exposure/2))
+            self.Rest(exposure/1e6/2)
+            self.AutoExposure(target=target, tolerance=tolerance, initial_exposure=exposure, gain=gain, frac_saturated=frac_saturated, method=method)
+            if log: self.WriteLog()
+          return False
+      if not ((target - tolerance) <= value <= (target+tolerance)):
+        print(f'Check failed: mean/median value is {value:.2f} (target: {target:.2f} +- {tolerance:.2f})   (method is {method})')
         if fix:
           print('Running auto exposure... (after waiting %1.2f s)'%(exposure/2))
-          time.sleep(exposure/1e6/2)
+          self.Rest(exposure/1e6/2)
           self.AutoExposure(target=target, tolerance=tolerance, initial_exposure=exposure, gain=gain, frac_saturated=frac_saturated, method=method)
           if log: self.WriteLog()
         return False
-    if not ((target - tolerance) <= value <= (target+tolerance)):
-      print(f'Check failed: mean/median value is {value:.2f} (target: {target:.2f} +- {tolerance:.2f})   (method is {method})')
-      if fix:
-        print('Running auto exposure... (after waiting %1.2f s)'%(exposure/2))
-        time.sleep(exposure/1e6/2)
-        self.AutoExposure(target=target, tolerance=tolerance, initial_exposure=exposure, gain=gain, frac_saturated=frac_saturated, method=method)
-        if log: self.WriteLog()
-      return False
-    if log: self.WriteLog()
-    time.sleep(exposure/1e6/2)
-    return True
+      if log: self.WriteLog()
+      self.Rest(exposure/1e6/2)
+      return True
     
 
 
@@ -457,10 +736,11 @@ def main():
   parser = argparse.ArgumentParser(description='Take a pic')
   parser.add_argument('--exposure', '-t',  default=None, help='Exposure time')
   parser.add_argument('--gain', '-g',  default=None, help='Gain')
-  parser.add_argument('--format', '-f',  default='', help='Output format: TIFF, fits, jpg...')
+  parser.add_argument('--format', '-f',  default='', help='Output format: TIFF, fits, jpg, fit+jpg...')
   parser.add_argument('--name', '-o',  default='temp', help='Output name')
   parser.add_argument('--verbose', '-v', default=1, help='Level of verbosity')
   parser.add_argument('--autoExposure', '-a', action='store_true', help='Do auto exposure')
+  parser.add_argument('--backend', '-b', default=ZWO_BACKEND, help='Camera backend: asi or sim (simulated camera)')
   
   args, unknown = parser.parse_known_args()
   oname = args.name
@@ -468,7 +748,7 @@ def main():
   outformat = args.format.lower()
   autoExposure = args.autoExposure
 
-  cam = zwo(verbose=verbose)
+  cam = zwo(verbose=verbose, backend=args.backend)
 
   prev_gain, prev_exposure = cam.SettingFromLog(set=False)
   gain = int(args.gain) if args.gain is not None else prev_gain
@@ -0,0 +1,327 @@
+'''
+ Simulated ZWO ASI camera, with the same interface as the zwoasi module, so zwo can run without the camera:
+   cam = zwo(backend='sim')
+
+ Frames are synthesized from a sky-brightness model (a vignetted sky circle with stars) plus read and shot noise.
+ RAW16 frames are Bayer (RGGB) mosaics with the 12-bit data in the high bits, as the real camera; RGB24 frames are BGR.
+ Exposure and readout (USB transfer) latencies are modelled. By default they are not waited, but accumulated in the
+ camera clock (camera.elapsed), so benchmarks are fast and deterministic; use camera.realtime = True to wait them.
+'''
+
+import time
+import numpy as np
+
+from allsky.config import ZWO_SIM_USB_BANDWIDTH, ZWO_SIM_READOUT_OVERHEAD
+
+ASI_BAYER_RG = 0
+ASI_BAYER_BG = 1
+ASI_BAYER_GR = 2
+ASI_BAYER_RB = 3
+
+ASI_IMG_RAW8 = 0
+ASI_IMG_RGB24 = 1
+ASI_IMG_RAW16 = 2
+ASI_IMG_Y8 = 3
+ASI_IMG_END = -1
+
+ASI_GAIN = 0
+ASI_EXPOSURE = 1
+ASI_GAMMA = 2
+ASI_WB_R = 3
+ASI_WB_B = 4
+ASI_BRIGHTNESS = 5
+ASI_OFFSET = 5
+ASI_BANDWIDTHOVERLOAD = 6
+ASI_OVERCLOCK = 7
+ASI_TEMPERATURE = 8
+ASI_FLIP = 9
+ASI_AUTO_MAX_GAIN = 10
+ASI_AUTO_MAX_EXP = 11
+ASI_AUTO_MAX_BRIGHTNESS = 12
+ASI_HARDWARE_BIN = 13
+ASI_HIGH_SPEED_MODE = 14
+
+ASI_EXP_IDLE = 0
+ASI_EXP_WORKING = 1
+ASI_EXP_SUCCESS = 2
+ASI_EXP_FAILED = 3
+
+CAMERA_NAME = 'ZWO ASI224MC (simulated)'
+CAMERA_INFO = {'Name': CAMERA_NAME, 'CameraID': 0, 'MaxHeight': 976, 'MaxWidth': 1304, 'IsColorCam': True,
+               'BayerPattern': ASI_BAYER_RG, 'SupportedBins': [1, 2, 3, 4], 'SupportedVideoFormat': [ASI_IMG_RAW8, ASI_IMG_RGB24, ASI_IMG_RAW16, ASI_IMG_Y8],
+               'PixelSize': 3.75, 'MechanicalShutter': False, 'ST4Port': True, 'IsCoolerCam': False, 'IsUSB3Host': False,
+               'IsUSB3Camera': True, 'ElecPerADU': 3.99, 'BitDepth': 12, 'IsTriggerCam': False}
+
+# Name, ControlType, MinValue, MaxValue, DefaultValue, IsAutoSupported, IsWritable
+CONTROLS = [('Gain', ASI_GAIN, 0, 510, 200, True, True),
+            ('Exposure', ASI_EXPOSURE, 32, 2000000000, 10000, True, True),
+            ('Gamma', ASI_GAMMA, 1, 100, 50, False, True),
+            ('WB_R', ASI_WB_R, 1, 99, 52, True, True),
+            ('WB_B', ASI_WB_B, 1, 99, 95, True, True),
+            ('Offset', ASI_OFFSET, 0, 600, 8, False, True),
+            ('BandWidth', ASI_BANDWIDTHOVERLOAD, 40, 100, 50, True, True),
+            ('Flip', ASI_FLIP, 0, 3, 0, False, True),
+            ('AutoExpMaxGain', ASI_AUTO_MAX_GAIN, 0, 510, 255, False, True),
+            ('AutoExpMaxExpMS', ASI_AUTO_MAX_EXP, 1, 60000, 100, False, True),
+            ('AutoExpTargetBrightness', ASI_AUTO_MAX_BRIGHTNESS, 50, 160, 100, False, True),
+            ('HighSpeedMode', ASI_HIGH_SPEED_MODE, 0, 1, 0, False, True),
+            ('Temperature', ASI_TEMPERATURE, -500, 1000, 20, False, False)]
+
+
+class ZWO_Error(Exception):
+  pass
+
+class ZWO_CaptureError(ZWO_Error):
+  pass
+
+
+def init(library_file=None):
+  ''' Nothing to load '''
+  return
+
+def get_num_cameras():
+  return 1
+
+def list_cameras():
+  return [CAMERA_NAME]
+
+
+def MakeSkyScene(height, width, seed=0, nstars=600):
+  ''' Radiance map (RGB, in 12-bit ADU per second at gain 0) of a clear sky: vignetted sky circle and some stars '''
+  rng = np.random.default_rng(seed)
+  yy, xx = np.mgrid[:height, :width]
+  r = np.hypot(yy - (height-1)/2., xx - (width-1)/2.) / (min(height, width)/2.)
+  sky = np.where(r < 1, 1 - 0.4*r**2, 0.).astype(np.float32)
+  scene = np.stack([sky*0.8, sky, sky*1.2], axis=2) # bluish sky
+  stars = rng.integers(0, height*width, nstars)
+  flux = rng.pareto(1.5, nstars).astype(np.float32) * 2000
+  color = rng.uniform(0.7, 1.3, (nstars, 3)).astype(np.float32)
+  inside = sky.flat[stars] > 0
+  scene.reshape(-1, 3)[stars[inside]] += flux[inside, None] * color[inside]
+  return scene
+
+
+class Camera:
+  ''' Simulated ASI camera '''
+
+  def __init__(self, id_=0, seed=0):
+    if id_ not in (0, CAMERA_NAME):
+      raise IndexError('Invalid id')
+    self.id = 0
+    self.default_timeout = -1
+    self.closed = False
+    self.realtime = False
+    self.elapsed = 0. # modelled camera time, in seconds
+    self.frames = 0
+    self.dropped = 0
+    self.temperature = 250 # in 0.1 C
+    self.read_noise = 2.   # in ADU
+    self.rng = np.random.default_rng(seed)
+    self.values = {c[1]: c[4] for c in CONTROLS}
+    self.roi_format = [CAMERA_INFO['MaxWidth'], CAMERA_INFO['MaxHeight'], 1, ASI_IMG_RAW8]
+    self.start_position = [0, 0]
+    self.exposure_status = ASI_EXP_IDLE
+    self.data = None
+    self.video = False
+    self.SetScene(MakeSkyScene(CAMERA_INFO['MaxHeight'], CAMERA_INFO['MaxWidth'], seed=seed))
+    self.SetSkyBrightness(50.)
+
+  #######################################################################################################################
+  ### Sky model
+  #######################################################################################################################
+
+  def SetScene(self, scene):
+    ''' Set the radiance map of the scene (RGB, full sensor resolution, in 12-bit ADU per second at gain 0 for brightness = 1) '''
+    self.scene = np.asarray(scene, dtype=np.float32)
+    self.binned = {1: self.scene}
+
+  def SetSkyBrightness(self, brightness):
+    ''' Scale of the scene: ~1e5 for day time, ~1e3 at sunset, ~1 for a dark night '''
+    self.brightness = float(brightness)
+
+  def GetScene(self):
+    ''' Scene for the current binning and ROI '''
+    width, height, bins, _ = self.roi_format
+    if bins not in self.binned:
+      h, w = self.scene.shape[0]//bins, self.scene.shape[1]//bins
+      self.binned[bins] = self.scene[:h*bins, :w*bins].reshape(h, bins, w, bins, 3).mean(axis=(1, 3))
+    x, y = self.start_position
+    return self.binned[bins][y:y+height, x:x+width]
+
+  def Synthesize(self):
+    ''' Synthesize a frame for the current controls, image type, binning and ROI '''
+    _, _, _, image_type = self.roi_format
+    exposure = self.values[ASI_EXPOSURE]/1e6
+    gain = 10**(self.values[ASI_GAIN]/200.)
+    black = float(self.values[ASI_OFFSET])
+    signal = self.GetScene() * np.float32(self.brightness * exposure * gain)
+    if image_type == ASI_IMG_RGB24:
+      wb = np.array([self.values[ASI_WB_B]/50., 1., self.values[ASI_WB_R]/50.], dtype=np.float32)
+      signal = signal[:, :, ::-1] * wb # BGR
+    else:
+      # Bayer RGGB mosaic
+      mosaic = np.empty(signal.shape[:2], dtype=np.float32)
+      mosaic[0::2, 0::2] = signal[0::2, 0::2, 0]
+      mosaic[0::2, 1::2] = signal[0::2, 1::2, 1]
+      mosaic[1::2, 0::2] = signal[1::2, 0::2, 1]
+      mosaic[1::2, 1::2] = signal[1::2, 1::2, 2]
+      signal = mosaic
+    noise = self.rng.standard_normal(signal.shape, dtype=np.float32)
+    noise *= np.sqrt(self.read_noise**2 + signal*gain/CAMERA_INFO['ElecPerADU'])
+    frame = np.clip(signal + noise + black, 0, 4095)
+    if image_type == ASI_IMG_RAW16:
+      return (frame.astype(np.uint16) << 4)
+    return (frame / 16).astype(np.uint8)
+
+  def ReadoutTime(self):
+    ''' Time to transfer a frame, in seconds '''
+    width, height, _, image_type = self.roi_format
+    nbytes = width * height * {ASI_IMG_RAW16: 2, ASI_IMG_RGB24: 3}.get(image_type, 1)
+    return ZWO_SIM_READOUT_OVERHEAD + nbytes / (ZWO_SIM_USB_BANDWIDTH * self.values[ASI_BANDWIDTHOVERLOAD]/100.)
+
+  def Wait(self, seconds):
+    ''' Advance the camera clock, waiting if in real time '''
+    self.elapsed += seconds
+    if self.realtime: time.sleep(seconds)
+
+  #######################################################################################################################
+  ### zwoasi.Camera interface
+  #######################################################################################################################
+
+  def get_camera_property(self):
+    return dict(CAMERA_INFO)
+
+  def get_num_controls(self):
+    return len(CONTROLS)
+
+  def get_controls(self):
+    r = {}
+    for name, ctype, vmin, vmax, default, isauto, iswritable in CONTROLS:
+      r[name] = {'Name': name, 'Description': name, 'MaxValue': vmax, 'MinValue': vmin, 'DefaultValue': default,
+                 'IsAutoSupported': isauto, 'IsWritable': iswritable, 'ControlType': ctype}
+    return r
+
+  def get_control_value(self, control_type):
+    if control_type == ASI_TEMPERATURE:
+      return [self.temperature, False]
+    return [self.values[control_type], False]
+
+  def set_control_value(self, control_type, value, auto=False):
+    for name, ctype, vmin, vmax, default, isauto, iswritable in CONTROLS:
+      if ctype == control_type:
+        if not iswritable: raise ZWO_Error('Control %s is not writable'%name)
+        self.values[ctype] = int(min(max(value, vmin), vmax))
+        return
+    raise ZWO_Error('Invalid control type')
+
+  def get_control_values(self):
+    return {name: self.get_control_value(ctype)[0] for name, ctype, _, _, _, _, _ in CONTROLS}
+
+  def get_roi_format(self):
+    return list(self.roi_format)
+
+  def set_roi_format(self, width, height, bins, image_type):
+    if bins not in CAMERA_INFO['SupportedBins']: raise ValueError('Illegal value for bins')
+    if width % 8 or height % 2: raise ZWO_Error('Invalid ROI size')
+    self.roi_format = [int(width), int(height), int(bins), int(image_type)]
+
+  def get_roi_start_position(self):
+    return list(self.start_position)
+
+  def set_roi_start_position(self, start_x, start_y):
+    self.start_position = [int(start_x), int(start_y)]
+
+  def get_roi(self):
+    return self.get_roi_start_position() + self.get_roi_format()[0:2]
+
+  def set_roi(self, start_x=None, start_y=None, width=None, height=None, bins=None, image_type=None):
+    whbi = self.get_roi_format()
+    if bins is None: bins = whbi[2]
+    if image_type is None: image_type = whbi[3]
+    maxw, maxh = int(CAMERA_INFO['MaxWidth'] / bins), int(CAMERA_INFO['MaxHeight'] / bins)
+    if width is None: width = maxw - maxw % 8
+    if height is None: height = maxh - maxh % 2
+    if start_x is None: start_x = int((maxw - width) / 2)
+    if start_y is None: start_y = int((maxh - height) / 2)
+    if start_x + width > maxw or start_y + height > maxh:
+      raise ValueError('ROI and start position larger than binned sensor size')
+    self.set_roi_format(width, height, bins, image_type)
+    self.set_roi_start_position(start_x, start_y)
+
+  def get_bin(self):
+    return self.roi_format[2]
+
+  def get_image_type(self):
+    return self.roi_format[3]
+
+  def set_image_type(self, image_type):
+    self.roi_format[3] = image_type
+
+  def get_dropped_frames(self):
+    return self.dropped
+
+  def start_exposure(self, is_dark=False):
+    self.exposure_status = ASI_EXP_WORKING
+    self.data = self.Synthesize()
+    self.Wait(self.values[ASI_EXPOSURE]/1e6)
+    self.exposure_status = ASI_EXP_SUCCESS
+
+  def stop_exposure(self):
+    self.exposure_status = ASI_EXP_IDLE
+
+  def get_exposure_status(self):
+    return self.exposure_status
+
+  def get_data_after_exposure(self, buffer_=None):
+    if self.exposure_status != ASI_EXP_SUCCESS: raise ZWO_Error('No exposure available')
+    self.Wait(self.ReadoutTime())
+    self.exposure_status = ASI_EXP_IDLE
+    self.frames += 1
+    return self.ToBuffer(self.data, buffer_)
+
+  def ToBuffer(self, data, buffer_=None):
+    if buffer_ is None: return bytearray(data.tobytes())
+    if len(buffer_) != data.nbytes: raise ValueError('Buffer has the wrong size')
+    np.frombuffer(buffer_, dtype=data.dtype)[:] = data.ravel()
+    return buffer_
+
+  def FromBuffer(self, data):
+    width, height, _, image_type = self.roi_format
+    if image_type == ASI_IMG_RAW16:
+      return np.frombuffer(data, dtype=np.uint16).reshape(height, width)
+    elif image_type == ASI_IMG_RGB24:
+      return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, width)
+
+  def Save(self, img, filename):
+    import cv2
+    cv2.imwrite(filename, img)
+
+  def capture(self, initial_sleep=0.01, poll=0.01, buffer_=None, filename=None):
+    self.start_exposure()
+    if self.get_exposure_status() != ASI_EXP_SUCCESS:
+      raise ZWO_CaptureError('Could not capture image')
+    img = self.FromBuffer(self.get_data_after_exposure(buffer_))
+    if filename is not None: self.Save(img, filename)
+    return img
+
+  def start_video_capture(self):
+    self.video = True
+
+  def stop_video_capture(self):
+    self.video = False
+
+  def get_video_data(self, timeout=None, buffer_=None):
+    if not self.video: raise ZWO_Error('Video capture not started')
+    data = self.Synthesize()
+    self.Wait(max(self.values[ASI_EXPOSURE]/1e6, self.ReadoutTime()))
+    self.frames += 1
+    return self.ToBuffer(data, buffer_)
+
+  def capture_video_frame(self, buffer_=None, filename=None, timeout=None):
+    img = self.FromBuffer(self.get_video_data(timeout=timeout, buffer_=buffer_))
+    if filename is not None: self.Save(img, filename)
+    return img
+
+  def close(self):
+    self.closed = True
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+'''
+ Convergence benchmark for the auto exposure solvers, on synthetic scenes with the simulated camera (allsky.zwosim).
+ For each scene and starting exposure it runs zwo.AutoExposure with the 'ratio' and the 'histogram' solvers and reports
+ the number of frames, the modelled camera time (exposures + readout + sleeps) and the computing time.
+
+   >> python3 scripts/benchAutoExposure.py
+'''
+
+import argparse, time
+import numpy as np
+
+import allsky.zwo as zwomodule
+from allsky.zwo import zwo
+
+class Clock:
+  ''' Modelled time for the sleeps in zwo: they are accumulated instead of waited '''
+  def __init__(self):
+    self.elapsed = 0.
+  def sleep(self, seconds):
+    self.elapsed += max(seconds, 0)
+  def time(self):
+    return time.time()
+
+def MakeScene(name, shape=(976, 1304), seed=1):
+  ''' Radiance maps for some typical allsky scenes (in 8-bit DN/s at gain 0) '''
+  rng = np.random.default_rng(seed)
+  h, w = shape
+  yy, xx = np.mgrid[:h, :w]
+  r = np.hypot(yy - h/2., xx - w/2.) / (min(h, w)/2.)
+  sky = np.where(r < 1, 1., 0.02)
+  if name == 'day':
+    rad = 4000 * sky * (1 + 0.5*r)
+    rad += 1e6 * np.exp(-((yy - h*0.3)**2 + (xx - w*0.6)**2)/(2*15.**2)) # sun
+  elif name == 'twilight':
+    rad = 150 * sky * (0.2 + (xx/w)**2)
+  elif name == 'night':
+    rad = 6 * sky
+    stars = rng.integers(0, h*w, 400)
+    rad.flat[stars] += rng.uniform(50, 3000, 400)
+  elif name == 'moon':
+    rad = 25 * sky * (1 + np.exp(-((yy - h*0.4)**2 + (xx - w*0.4)**2)/(2*60.**2))*5)
+    rad += 2e5 * np.exp(-((yy - h*0.4)**2 + (xx - w*0.4)**2)/(2*8.**2))
+  else:
+    raise ValueError('Unknown scene: %s'%name)
+  return np.repeat(rad[:, :, None], 3, axis=2)
+
+def Run(cam, scene, solver, exposure, gain, method, target, tolerance, frac_saturated):
+  clock = Clock()
+  zwomodule.time = clock
+  cam.camera.SetScene(scene*16) # 8-bit DN --> 12-bit ADU
+  cam.camera.elapsed = 0.
+  frames = cam.camera.frames
+  t0 = time.time()
+  exp = cam.AutoExposure(initial_exposure=exposure, gain=gain, target=target, tolerance=tolerance, method=method, frac_saturated=frac_saturated, solver=solver)
+  cpu = time.time() - t0
+  camtime = cam.camera.elapsed + clock.elapsed
+  frames = cam.camera.frames - frames
+  value, frac = cam.MeterImage(cam.GetMeteringImage(), method)
+  zwomodule.time = time
+  return frames, camtime, cpu, exp, value, frac
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the auto exposure solvers')
+  parser.add_argument('--target', type=float, default=150)
+  parser.add_argument('--tolerance', type=float, default=20)
+  parser.add_argument('--method', default='max')
+  parser.add_argument('--frac_saturated', type=float, default=0.07)
+  args = parser.parse_args()
+  cam = zwo(verbose=0, backend='sim')
+  cam.camera.SetSkyBrightness(1.)
+
+  cases = [('day', 1000000, 0), ('day', 1000, 0), ('twilight', 50000, 0), ('twilight', 2000000, 0), ('night', 1000000, 60), ('moon', 4000000, 60)]
+  print('%-9s %10s | %-9s %6s %10s %8s %12s %8s %7s'%('scene', 'exp0 [us]', 'solver', 'frames', 'cam [s]', 'cpu [s]', 'exp [us]', 'value', 'sat [%]'))
+  totals = {}
+  for name, exposure, gain in cases:
+    scene = MakeScene(name)
+    for solver in ['ratio', 'histogram']:
+      frames, camtime, cpu, exp, value, frac = Run(cam, scene, solver, exposure, gain, args.method, args.target, args.tolerance, args.frac_saturated)
+      tot = totals.setdefault(solver, [0, 0., 0.])
+      tot[0] += frames; tot[1] += camtime; tot[2] += cpu
+      print('%-9s %10i | %-9s %6i %10.3f %8.3f %12i %8.1f %7.2f'%(name, exposure, solver, frames, camtime, cpu, exp, value, frac*100))
+  print('Totals:')
+  for solver, (frames, camtime, cpu) in totals.items():
+    print('  %-9s frames = %i, camera time = %1.2f s, cpu time = %1.3f s'%(solver, frames, camtime, cpu))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+'''
+ Calibration benchmark: dark-corrects a synthetic night of RAW16 frames (a few exposures and gains, so a few distinct
+ masters) with the previous per-frame reads (light opened twice, master read from disk for each frame) and with the
+ in-memory DarkCache, and reports the time per frame, the master reads and the agreement.
+
+   >> python3 scripts/benchCalibration.py -n 200
+   >> python3 scripts/benchCalibration.py -n 200 --budget 16
+'''
+
+import argparse, os, tempfile, time
+import numpy as np
+
+def LegacyCorrect(imgpath, darkpath):
+  ''' Correction of dark_correct_img before the dark cache: the header (to find the dark) and the data of the light
+      in two opens, the master read from disk; returns the corrected data and the header '''
+  from astropy.io import fits
+  with fits.open(imgpath) as light_image:
+    header = light_image[0].header
+  with fits.open(imgpath) as light_image:
+    light_data = light_image[0].data
+  with fits.open(darkpath) as dark_image:
+    dark_data = dark_image[0].data
+  return light_data - dark_data, header
+
+def CachedCorrect(imgpath, darkpath, cache):
+  from astropy.io import fits
+  with fits.open(imgpath) as light_image:
+    light_data = light_image[0].data.astype(np.float32)
+  return cache.Subtract(light_data, darkpath)
+
+def MakeNight(path, n, nmasters, height, width):
+  ''' Write nmasters float32 masters and n RAW16 lights, consecutive lights sharing the master as in a night '''
+  from astropy.io import fits
+  rng = np.random.default_rng(0)
+  masters = []
+  for i in range(nmasters):
+    masters.append(os.path.join(path, 'master_%02i.fit'%i))
+    fits.PrimaryHDU(rng.normal(1200 + 50*i, 20, (height, width)).astype(np.float32)).writeto(masters[-1])
+  frames = []
+  for i in range(n):
+    frames.append((os.path.join(path, 'light_%04i.fit'%i), masters[i * nmasters // n]))
+    fits.PrimaryHDU(rng.integers(1000, 5000, (height, width)).astype(np.uint16)).writeto(frames[-1][0])
+  return frames
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the dark calibration of a night of frames')
+  parser.add_argument('-n', type=int, default=100, help='Number of frames')
+  parser.add_argument('--masters', type=int, default=4, help='Number of distinct masters')
+  parser.add_argument('--size', type=int, nargs=2, default=[976, 1304], help='Frame height and width')
+  parser.add_argument('--budget', type=float, default=128, help='Dark cache budget, in MB')
+  args = parser.parse_args()
+
+  from allsky.darklib import DarkCache
+  with tempfile.TemporaryDirectory() as tmp:
+    frames = MakeNight(tmp, args.n, args.masters, *args.size)
+    t0 = time.time()
+    legacy = [LegacyCorrect(img, dark)[0] for img, dark in frames[:10]]
+    tlegacy = (time.time() - t0) / len(legacy)
+    cache = DarkCache(args.budget*1024**2)
+    t0 = time.time()
+    diff = 0
+    for i, (img, dark) in enumerate(frames):
+      corrected = CachedCorrect(img, dark, cache)
+      if i < len(legacy): diff = max(diff, np.abs(corrected - legacy[i]).max())
+    tcached = (time.time() - t0) / len(frames)
+    print('%i frames, %i masters'%(len(frames), args.masters))
+    print('legacy: %6.1f ms/frame, %i master reads'%(tlegacy*1e3, len(frames)))
+    print('cached: %6.1f ms/frame, %i master reads, %s'%(tcached*1e3, cache.misses, cache.Stats()))
+    print('max |diff| = %g ADU'%diff)
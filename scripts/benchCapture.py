@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+'''
+ Capture benchmark with the simulated camera (allsky.zwosim): capture throughput for each image type and cost of
+ the auto exposure. The camera time (exposure + readout) is modelled, the host time is measured (and includes
+ the sleeps in zwo).
+
+   >> python3 scripts/benchCapture.py -n 20 --exposure 0.1
+'''
+
+import argparse, time
+
+from allsky.zwo import zwo
+from allsky.timing import timer
+
+def BenchCapture(cam, image_type, nframes):
+  ''' Capture nframes in memory, return modelled camera time and host time per frame '''
+  cam.SetImageType(image_type)
+  cam.camera.elapsed = 0.
+  t0 = time.time()
+  for i in range(nframes):
+    cam.camera.capture()
+  host = time.time() - t0
+  return cam.camera.elapsed/nframes, host/nframes
+
+def BenchMetering(cam, bins, roi, nframes):
+  ''' Capture nframes metering frames with a given binning, return modelled camera time and host time per frame '''
+  with cam.MeteringFormat(bins=bins, roi=roi):
+    cam.camera.elapsed = 0.
+    t0 = time.time()
+    for i in range(nframes):
+      cam.MeterImage(cam.GetMeteringImage())
+    host = time.time() - t0
+  return cam.camera.elapsed/nframes, host/nframes
+
+def BenchVideo(cam, nframes, consumer_time=0.):
+  ''' Stream nframes in video mode, with a consumer that takes consumer_time seconds per frame '''
+  stream = cam.StartVideo()
+  for frame in stream:
+    if consumer_time: time.sleep(consumer_time)
+    if stream.delivered >= nframes: break
+  stream.Stop()
+  return stream.GetStats()
+
+def BenchSnap(cam, nframes):
+  ''' SDK calls per frame for a snap (capture, header and log) in memory '''
+  cam.ResetSDKCalls()
+  for i in range(nframes):
+    cam.SetImageType(cam.asi.ASI_IMG_RAW16)
+    cam.GetRawImage()
+    cam.CraftFitsHeader()
+  return {k: v/nframes for k, v in cam.GetSDKCalls().items()}
+
+def BenchAutoExposure(cam, solver, exposure, gain, brightness, nruns):
+  ''' Run the auto exposure nruns times from the same starting point '''
+  cam.camera.SetSkyBrightness(brightness)
+  cam.camera.elapsed = 0.
+  frames = cam.camera.frames
+  t0 = time.time()
+  for i in range(nruns):
+    cam.AutoExposure(initial_exposure=exposure, gain=gain, method='max', frac_saturated=0.07, solver=solver)
+  host = time.time() - t0
+  return (cam.camera.frames - frames)/nruns, cam.camera.elapsed/nruns, host/nruns
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark captures with the simulated camera')
+  parser.add_argument('-n', type=int, default=20, help='Number of frames per image type')
+  parser.add_argument('--exposure', type=float, default=0.1, help='Exposure time in seconds')
+  parser.add_argument('--gain', type=int, default=0, help='Gain')
+  parser.add_argument('--trace', default=None, help='Write a chrome trace of the run to this file')
+  args = parser.parse_args()
+
+  if args.trace: timer.EnableTrace()
+  cam = zwo(verbose=0, backend='sim')
+  cam.SetGain(args.gain)
+  cam.SetExposure(int(args.exposure*1e6))
+
+  print('Capture (%i frames, exp = %g s, gain = %i)'%(args.n, args.exposure, args.gain))
+  for name in ['RAW8', 'RAW16', 'RGB24']:
+    camtime, host = BenchCapture(cam, getattr(cam.asi, 'ASI_IMG_'+name), args.n)
+    print('  %-6s camera = %7.1f ms/frame, host = %7.1f ms/frame, %5.2f frames/s'%(name, camtime*1e3, host*1e3, 1./(camtime + host)))
+
+  print('Metering frames (RGB24)')
+  for bins, roi in [(1, False), (2, False), (2, True), (4, True)]:
+    camtime, host = BenchMetering(cam, bins, roi, args.n)
+    print('  bins = %i, roi = %-5s camera = %7.1f ms/frame, host = %7.1f ms/frame'%(bins, roi, camtime*1e3, host*1e3))
+
+  print('Video (RGB24, %i frames)'%args.n)
+  for consumer_time in [0., 0.3]:
+    stats = BenchVideo(cam, args.n, consumer_time)
+    print('  consumer = %4.0f ms/frame: %6.1f frames/s captured, %i delivered, %i dropped'%(consumer_time*1e3, stats['fps'], stats['delivered'], stats['dropped']))
+
+  print('SDK calls per frame (RAW16 + FITs header): ', BenchSnap(cam, args.n))
+
+  print('Auto exposure (method = max)')
+  for brightness, exposure in [(1e5, 1000000), (300, 50000), (1, 1000000)]:
+    for solver in ['ratio', 'histogram']:
+      frames, camtime, host = BenchAutoExposure(cam, solver, exposure, args.gain, brightness, 3)
+      print('  sky = %-8g %-9s frames = %4.1f, camera = %7.2f s, host = %6.3f s'%(brightness, solver, frames, camtime, host))
+
+  print('Latency per stage (host time)')
+  timer.Print()
+  if args.trace: timer.WriteChromeTrace(args.trace)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+'''
+ Debayer benchmark: ms/frame and peak memory (tracemalloc, numpy and cv2 arrays) of allsky.imgproc.debayer_data
+ against the previous float64 path, on a full resolution synthetic RAW16 frame, as it comes from the camera
+ (uint16) and after the dark subtraction (float32). The outputs must be identical. The tiled mode (debayer_tiled,
+ bands of rows under --memory MB) is measured including the dark subtraction, against subtracting and then debayering.
+
+   >> python3 scripts/benchDebayer.py
+   >> python3 scripts/benchDebayer.py --size 2822 4144 -n 5 --memory 8
+'''
+
+import argparse, time, tracemalloc
+import numpy as np
+import cv2
+
+def LegacyDebayer(data, bayer=0):
+  ''' debayer_data, white_balance and remove_hot_pixels before the lookup tables '''
+  from allsky.imgproc import BAYER_CODES
+  data_normalized = ((data - data.min()) / (data.max() - data.min()) * 65535).astype(np.uint16)
+  debayered_image = cv2.cvtColor(data_normalized, BAYER_CODES[bayer])
+  result = np.zeros_like(debayered_image)
+  for i in range(3):
+    channel = debayered_image[:, :, i]
+    scale = 32768.0 / np.median(channel)
+    result[:, :, i] = np.clip(channel * scale, 0, 65535)
+  balanced_image = result.astype(np.uint16)
+  filtered_image = cv2.medianBlur(balanced_image, 3)
+  return (filtered_image / 256).astype(np.uint8)
+
+def MakeFrame(height, width, seed=0):
+  ''' Sky-like RAW16 frame: a gradient, noise, stars and a few saturated pixels '''
+  rng = np.random.default_rng(seed)
+  y, x = np.mgrid[:height, :width]
+  frame = 2000 + 3000 * np.exp(-((x - width/2)**2 + (y - height/2)**2) / (0.5*width)**2)
+  frame += rng.normal(0, 50, (height, width))
+  frame[rng.integers(0, height, 500), rng.integers(0, width, 500)] = 65535
+  return np.clip(frame, 0, 65535).astype(np.uint16)
+
+def Measure(func, data, n, **kwargs):
+  ''' ms/frame (best of n) and peak traced memory of one call, in MB, counting the working buffers kept between frames '''
+  from allsky import imgproc
+  func(data, **kwargs) # warm up (and the working buffers)
+  times = []
+  for i in range(n):
+    t0 = time.perf_counter()
+    out = func(data, **kwargs)
+    times.append(time.perf_counter() - t0)
+  imgproc._local.__dict__.pop('buffers', None)
+  tracemalloc.start()
+  func(data, **kwargs)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return out, min(times)*1e3, peak/1024**2
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the debayer of a RAW16 frame')
+  parser.add_argument('--size', type=int, nargs=2, default=[976, 1304], help='Frame height and width')
+  parser.add_argument('-n', type=int, default=10, help='Repetitions')
+  parser.add_argument('--memory', type=float, default=16, help='Working memory of the tiled mode, in MB')
+  args = parser.parse_args()
+
+  from allsky.imgproc import debayer_data, debayer_tiled
+  raw = MakeFrame(*args.size)
+  dark = np.random.default_rng(1).normal(1000, 10, args.size).astype(np.float32)
+  print('%ix%i frame'%tuple(args.size))
+  print('%-10s %-8s %10s %14s %10s'%('input', 'method', 'ms/frame', 'peak mem [MB]', 'identical'))
+  for name, data in [('uint16', raw), ('float32', raw - dark)]:
+    reference, ms, peak = Measure(LegacyDebayer, data, args.n)
+    print('%-10s %-8s %10.1f %14.1f'%(name, 'legacy', ms, peak))
+    out, ms, peak = Measure(debayer_data, data, args.n)
+    print('%-10s %-8s %10.1f %14.1f %10s'%(name, 'lut', ms, peak, np.array_equal(out, reference)))
+  hotpixels = np.flatnonzero(raw == 65535).astype(np.uint32)
+  out, ms, peak = Measure(debayer_data, raw, args.n, hotpixels=hotpixels)
+  print('%-10s %-8s %10.1f %14.1f %10s'%('uint16', 'lut+map', ms, peak, '-'))
+
+  # Dark subtraction + debayer, whole frame or in bands
+  Calibrated = lambda raw, dark: debayer_data(np.subtract(raw, dark, dtype=np.float32))
+  reference, ms, peak = Measure(Calibrated, raw, args.n, dark=dark)
+  print('%-10s %-8s %10.1f %14.1f'%('raw-dark', 'frame', ms, peak))
+  out, ms, peak = Measure(debayer_tiled, raw, args.n, dark=dark, memory=args.memory*1024**2)
+  print('%-10s %-8s %10.1f %14.1f %10s'%('raw-dark', 'tiled', ms, peak, np.array_equal(out, reference)))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+'''
+ Import-time benchmark: imports each module in a fresh process with -X importtime, reports the cumulative import
+ time and the slowest imports, and fails (exit code 1) if the time is over the threshold or if a heavy dependency
+ that should be deferred to first use gets imported.
+
+   >> python3 scripts/benchImportTime.py
+   >> python3 scripts/benchImportTime.py allsky.zwo --max-ms 300 --top 20
+'''
+
+import argparse, os, subprocess, sys
+
+# Heavy dependencies that must only be imported on first use
+FORBIDDEN = ['cv2', 'astropy', 'astroplan', 'matplotlib', 'ephem', 'pytz', 'zwoasi']
+
+def ImportTimes(module):
+  ''' Import a module in a fresh process; returns [(name, self us, cumulative us)] in import order '''
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.pathsep + env.get('PYTHONPATH', '')
+  out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s'%module], capture_output=True, text=True, env=env)
+  if out.returncode != 0: raise RuntimeError(out.stderr.strip().splitlines()[-1])
+  times = []
+  for line in out.stderr.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line: continue
+    selftime, cumulative, name = line[len('import time:'):].split('|')
+    times.append((name.strip(), int(selftime), int(cumulative)))
+  return times
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the import time of the allsky modules')
+  parser.add_argument('modules', nargs='*', default=['allsky.zwo', 'allsky.obscoor'], help='Modules to import')
+  parser.add_argument('--max-ms', type=float, default=400, help='Maximum cumulative import time, in ms')
+  parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to print')
+  args = parser.parse_args()
+
+  failed = False
+  for module in args.modules:
+    times = ImportTimes(module)
+    total = [c for name, s, c in times if name == module][0] / 1e3
+    forbidden = sorted(set(name for name, s, c in times if name.split('.')[0] in FORBIDDEN))
+    ok = total <= args.max_ms and not forbidden
+    failed |= not ok
+    print('%-20s %8.1f ms  %s'%(module, total, 'OK' if ok else 'FAIL'))
+    if forbidden: print('  imports heavy dependencies: %s'%', '.join(forbidden))
+    for name, s, c in sorted(times, key=lambda x: -x[1])[:args.top]:
+      print('    %-40s self = %7.1f ms, cumulative = %7.1f ms'%(name, s/1e3, c/1e3))
+  sys.exit(1 if failed else 0)
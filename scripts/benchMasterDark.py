@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+'''
+ Master dark benchmark: peak memory (anonymous RSS) and throughput combining n synthetic RAW16 darks with the previous
+ in-memory combination (np.median of the list of frames) and with the tiled allsky.darklib.CombineDarks.
+ Each run is a fresh process so the peak RSS is not polluted by the previous ones.
+
+   >> python3 scripts/benchMasterDark.py -n 10
+   >> python3 scripts/benchMasterDark.py -n 40 --memory 32
+'''
+
+import argparse, json, os, subprocess, sys, tempfile, threading, time
+import numpy as np
+from astropy.io import fits # imported before the sampler starts in the child, so it is not counted in the peak
+
+def LegacyMasterDark(dark_files, method='median'):
+  ''' Combination of create_master_dark before the tiled combiner '''
+  darks = []
+  for dark_file in dark_files:
+    with fits.open(dark_file) as dark_fits:
+      darks.append(dark_fits[0].data)
+  return np.median(darks, axis=0) if method == 'median' else np.mean(darks, axis=0)
+
+def MakeDarks(path, n, height, width):
+  ''' Write n synthetic RAW16 darks (as zwo writes them: uint16 stored with BZERO) '''
+  rng = np.random.default_rng(0)
+  bias = rng.normal(1200, 30, (height, width))
+  hot = rng.random((height, width)) < 1e-3
+  files = []
+  for i in range(n):
+    data = bias + rng.normal(0, 20, (height, width)) + hot*30000
+    if i == 0: data[::97, ::89] = 65535 # a few outliers (cosmic rays)
+    files.append(os.path.join(path, 'dark_%03i.fit'%i))
+    fits.PrimaryHDU(np.clip(data, 0, 65535).astype(np.uint16)).writeto(files[-1], overwrite=True)
+  return files
+
+def GetAnonRSS():
+  ''' Anonymous resident memory (Linux), in kB -- the memory-mapped file pages are not counted: they are reclaimable '''
+  with open('/proc/self/status') as f:
+    for line in f:
+      if line.startswith('RssAnon:'): return int(line.split()[1])
+
+class PeakSampler:
+  ''' Sample the anonymous RSS every few ms in a thread and keep the peak '''
+  def __init__(self, interval=0.002):
+    self.interval = interval
+    self.base = self.peak = GetAnonRSS()
+    self.running = True
+    self.thread = threading.Thread(target=self.Run, daemon=True)
+    self.thread.start()
+
+  def Run(self):
+    while self.running:
+      self.peak = max(self.peak, GetAnonRSS())
+      time.sleep(self.interval)
+
+  def Stop(self):
+    self.running = False
+    self.thread.join()
+    self.peak = max(self.peak, GetAnonRSS())
+    return (self.peak - self.base) / 1024.
+
+def Child(method, files, memory, output):
+  ''' Run in the child process: combine and report time and peak memory over the baseline '''
+  from allsky.darklib import CombineDarks
+  sampler = PeakSampler()
+  t0 = time.time()
+  if method.startswith('legacy'):
+    master = LegacyMasterDark(files, method.split('-')[1])
+  else:
+    master = CombineDarks(files, method, memory=memory*1024**2)
+  elapsed = time.time() - t0
+  peak = sampler.Stop()
+  np.save(output, master)
+  print(json.dumps({'time': elapsed, 'peak': peak}))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the master dark combination')
+  parser.add_argument('-n', type=int, default=10, help='Number of darks')
+  parser.add_argument('--size', type=int, nargs=2, default=[976, 1304], help='Frame height and width')
+  parser.add_argument('--memory', type=float, default=64, help='Memory budget of the tiled combiner, in MB')
+  parser.add_argument('--child', nargs=3, default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child is not None:
+    method, listfile, output = args.child
+    with open(listfile) as f: files = f.read().split()
+    Child(method, files, args.memory, output)
+    sys.exit(0)
+
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.pathsep + env.get('PYTHONPATH', '')
+  with tempfile.TemporaryDirectory() as tmp:
+    files = MakeDarks(tmp, args.n, *args.size)
+    listfile = os.path.join(tmp, 'files.txt')
+    with open(listfile, 'w') as f: f.write('\n'.join(files))
+    mbytes = args.n * args.size[0] * args.size[1] * 2 / 1024**2
+    print('%i darks of %ix%i (%1.0f MB), budget = %g MB'%(args.n, args.size[0], args.size[1], mbytes, args.memory))
+    print('%-14s %9s %12s %12s %16s'%('method', 'time [s]', 'MB/s', 'peak mem [MB]', 'max |diff| [ADU]'))
+    results = {}
+    for method in ['legacy-median', 'median', 'legacy-mean', 'mean', 'sigma']:
+      output = os.path.join(tmp, method + '.npy')
+      out = subprocess.run([sys.executable, __file__, '--memory', str(args.memory), '--child', method, listfile, output], capture_output=True, text=True, env=env)
+      if out.returncode != 0:
+        print('%-14s failed: %s'%(method, out.stderr.strip().splitlines()[-1:]))
+        continue
+      r = json.loads(out.stdout.strip().splitlines()[-1])
+      results[method] = np.load(output)
+      reference = results.get('legacy-' + method)
+      diff = '%16.3g'%np.abs(results[method] - reference).max() if reference is not None else ''
+      print('%-14s %9.2f %12.1f %12.1f %s'%(method, r['time'], mbytes/r['time'], r['peak'], diff))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+'''
+ Sky-phase benchmark: cost of the phase queries with the astroplan solvers (one solve per query) and with the
+ precomputed timeline of obscoor, and agreement between both on a grid of times; cost of the batch
+ classification of a planning grid at minute resolution.
+
+   >> python3 scripts/benchSkyPhase.py -n 20 --hours 48
+'''
+
+import argparse, time
+import numpy as np
+from astropy.time import Time
+
+from allsky import obscoor as obscoormodule
+from allsky.obscoor import obscoor, SkyTimeline, ClassifyPhases, PhaseFromAltitude, PHASE_NAMES, DAY, TWILIGHT, NAUTICAL, ASTRONOMICAL
+
+def LegacyPhase(obs, t):
+  ''' Sky phase with the astroplan solvers, as the Sequencer used to decide it '''
+  if not obscoormodule.IsNight(obs, t): return DAY
+  if obscoormodule.IsAstronomicalTwilight(obs, t): return ASTRONOMICAL
+  if obscoormodule.IsNauticalTwilight(obs, t): return NAUTICAL
+  return TWILIGHT
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the sky-phase queries')
+  parser.add_argument('-n', type=int, default=20, help='Number of queries with the astroplan solvers')
+  parser.add_argument('--hours', type=float, default=48, help='Hours covered by the agreement check')
+  parser.add_argument('--step', type=float, default=10, help='Minutes between times in the agreement check')
+  parser.add_argument('--days', type=float, default=365, help='Days covered by the batch classification (1 min resolution)')
+  args = parser.parse_args()
+
+  o = obscoor()
+  now = time.time()
+
+  t0 = time.time()
+  for i in range(args.n):
+    LegacyPhase(o.obs, Time(now + i*60, format='unix'))
+  legacy = (time.time() - t0) / args.n
+  print('astroplan solvers: %8.2f ms/query'%(legacy*1e3))
+
+  t0 = time.time()
+  timeline = SkyTimeline(o.obs, now)
+  build = time.time() - t0
+  print('timeline build   : %8.2f ms (%i events)'%(build*1e3, len(timeline.times)))
+
+  nq = 100000
+  t0 = time.time()
+  for i in range(nq):
+    o.GetPhase(now + i*0.1)
+  cached = (time.time() - t0) / nq
+  print('timeline query   : %8.4f ms/query (%1.0fx faster)'%(cached*1e3, legacy/cached))
+
+  # Agreement with the astroplan solvers
+  times = now + np.arange(0, args.hours*3600, args.step*60)
+  disagree = []
+  for t in times:
+    new, old = o.GetPhase(t), LegacyPhase(o.obs, Time(t, format='unix'))
+    if new != old: disagree.append((t, old, new))
+  print('agreement        : %i/%i times'%(len(times) - len(disagree), len(times)))
+  for t, old, new in disagree:
+    print('  %s  astroplan = %-12s timeline = %s'%(Time(t, format='unix').iso, PHASE_NAMES[old], PHASE_NAMES[new]))
+
+  # Batch classification of a planning grid
+  times = now + np.arange(0, args.days*86400, 60.)
+  t0 = time.time()
+  phases = ClassifyPhases(o.obs, times)
+  batch = time.time() - t0
+  print('batch            : %8.3f s for %i times (%1.2f us/time)'%(batch, len(times), batch/len(times)*1e6))
+  sample = np.random.default_rng(0).choice(len(times), 500, replace=False)
+  exact = PhaseFromAltitude(o.obs.sun_altaz(Time(times[sample], format='unix')).alt.deg)
+  print('batch agreement  : %i/%i sampled times with the exact sun position'%(np.count_nonzero(exact == phases[sample]), len(sample)))
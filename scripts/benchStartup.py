@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+'''
+ Start-up benchmark without network: time to the first phase decision (import, obscoor, IsNight and the moon for the
+ FITs header) in a fresh process, with the IERS offline mode on and off. The network is blocked in the child
+ processes: every connection (or name lookup) waits --stall seconds and fails, as on a site with a flaky link.
+ The astropy tables are treated as older than --max-age days so the online mode tries to refresh them, as it
+ happens on the Pi when the bundled tables get old.
+
+   >> python3 scripts/benchStartup.py --stall 5
+'''
+
+import argparse, json, os, subprocess, sys, time
+
+def Child(offline, stall, max_age):
+  ''' Run in the child process: block the network, start obscoor and take a phase decision '''
+  import socket
+  attempts = []
+  def Blocked(*args, **kwargs):
+    attempts.append(str(args[1:2]))
+    time.sleep(stall)
+    raise OSError('Network disabled by benchStartup')
+  socket.socket.connect = Blocked
+  socket.getaddrinfo = Blocked
+
+  t0 = time.time()
+  import allsky.config
+  allsky.config.IERS_OFFLINE = offline
+  from astropy.utils import iers
+  iers.conf.auto_max_age = max_age
+  from allsky.obscoor import obscoor
+  timport = time.time() - t0
+  o = obscoor()
+  tinit = time.time() - t0
+  try:
+    night = o.IsNight()
+    moon = o.GetMoonPhase()
+    error = None
+  except Exception as e:
+    night, moon, error = None, None, str(e)
+  tfirst = time.time() - t0
+  print(json.dumps({'import': timport, 'init': tinit, 'first': tfirst, 'attempts': len(attempts), 'night': night, 'moon': moon, 'error': error}))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the start-up without network')
+  parser.add_argument('--stall', type=float, default=5, help='Seconds each blocked connection waits before failing')
+  parser.add_argument('--max-age', type=float, default=11, help='Age (days, > 10) after which astropy tries to refresh its tables when online')
+  parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child is not None:
+    Child(args.child == 'offline', args.stall, args.max_age)
+    sys.exit(0)
+
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.pathsep + env.get('PYTHONPATH', '')
+  print('%-8s %10s %10s %14s %9s'%('mode', 'import [s]', 'init [s]', 'decision [s]', 'network'))
+  for mode in ['online', 'offline']:
+    out = subprocess.run([sys.executable, __file__, '--child', mode, '--stall', str(args.stall), '--max-age', str(args.max_age)],
+                         capture_output=True, text=True, env=env)
+    if out.returncode != 0 or not out.stdout.strip():
+      print('%-8s failed: %s'%(mode, out.stderr.strip().splitlines()[-1:] ))
+      continue
+    r = json.loads(out.stdout.strip().splitlines()[-1])
+    print('%-8s %10.2f %10.2f %14.2f %9i'%(mode, r['import'], r['init'], r['first'], r['attempts']) + ('   ERROR: %s'%r['error'].splitlines()[0] if r['error'] else ''))
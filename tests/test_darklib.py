@@ -0,0 +1,69 @@
+import os
+import numpy as np
+from astropy.io import fits
+
+from allsky.darklib import DarkLibrary, FindHotPixels, HotPixelMaps
+from allsky.imgproc import correct_hot_pixels
+
+
+def MakeMaster(shape, hot=(), dead=(), seed=0):
+  ''' Flat master (1000 ADU, noise of 5) with hot (30000) and dead (0) pixels at the given (row, col) '''
+  master = np.random.default_rng(seed).normal(1000, 5, shape).astype(np.float32)
+  for p in hot: master[p] = 30000
+  for p in dead: master[p] = 0
+  return master
+
+def WriteMaster(path, temp, exp, gain, master):
+  ''' Master in the darks tree: temp(0.1C)/exp/gain/temp_gain_exp_master.fit '''
+  folder = os.path.join(path, str(temp), str(exp), str(gain))
+  os.makedirs(folder, exist_ok=True)
+  fits.PrimaryHDU(master).writeto(os.path.join(folder, '%i_%i_%i_master.fit'%(temp, gain, exp)))
+
+def FlatIndices(points, shape):
+  return sorted(np.ravel_multi_index(tuple(np.transpose(points)), shape).tolist())
+
+
+def test_find_hot_pixels():
+  shape = (40, 60)
+  hot, dead = [(3, 7), (20, 59), (39, 0)], [(0, 0), (25, 30)]
+  indices = FindHotPixels(MakeMaster(shape, hot, dead))
+  assert indices.dtype == np.uint32
+  assert sorted(indices.tolist()) == FlatIndices(hot + dead, shape)
+
+def test_hot_pixel_maps_build(tmp_path):
+  shape = (20, 30)
+  path = str(tmp_path)
+  # Bucket (200, 100): the map comes from the longest exposure
+  WriteMaster(path, 200, 10, 100, MakeMaster(shape, hot=[(1, 1)], seed=1))
+  WriteMaster(path, 200, 60, 100, MakeMaster(shape, hot=[(5, 6), (10, 12)], dead=[(19, 29)], seed=2))
+  WriteMaster(path, 350, 60, 100, MakeMaster(shape, hot=[(2, 3)], seed=3))
+  library = DarkLibrary(path, index=os.path.join(path, 'index.json'))
+  filename = os.path.join(path, 'hotpixels.npz')
+  maps = HotPixelMaps(filename).Build(library)
+  assert len(maps) == 2
+  assert maps.shape == shape
+  assert sorted(maps.Get(200, 100).tolist()) == FlatIndices([(5, 6), (10, 12), (19, 29)], shape)
+  assert maps.Get(330, 100).tolist() == FlatIndices([(2, 3)], shape)
+  # Saved, and read back the same
+  maps = HotPixelMaps(filename)
+  assert len(maps) == 2
+  assert maps.Get(210, 100).tolist() == maps.maps[(200, 100)].tolist()
+
+def test_hot_pixel_maps_without_file(tmp_path):
+  maps = HotPixelMaps(str(tmp_path / 'hotpixels.npz'))
+  assert len(maps) == 0
+  assert maps.Get(200, 100) is None
+
+def test_correct_hot_pixels_edges():
+  shape = (8, 10)
+  data = np.random.default_rng(0).integers(1000, 2000, shape).astype(np.uint16)
+  points = [(0, 0), (0, 5), (4, 0), (7, 9), (3, 4)] # corners, edges and one inside
+  expected = data.copy()
+  for r, c in points:
+    # Same-colour neighbours two pixels away, mirrored inside the frame at the edges
+    rows = [r - 2 if r >= 2 else r + 2, r + 2 if r < shape[0] - 2 else r - 2]
+    cols = [c - 2 if c >= 2 else c + 2, c + 2 if c < shape[1] - 2 else c - 2]
+    values = sorted(int(v) for v in [data[rows[0], c], data[rows[1], c], data[r, cols[0]], data[r, cols[1]]])
+    expected[r, c] = (values[1] + values[2]) // 2
+  corrected = correct_hot_pixels(data.copy(), np.array(FlatIndices(points, shape), dtype=np.uint32))
+  assert np.array_equal(corrected, expected)